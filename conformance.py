@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Differential conformance harness for the MUSYSim engines.
+
+Runs every program with both the reference and fast engines and
+compares EXP, the variables, STDOUT, every bus word and the step count.
+Programs are all of examples/*.musys, the paper programs used in
+tests/test_musys.py, and randomly generated programs with fixed seeds.
+"""
+
+import argparse
+import ast
+import glob
+import io
+import os
+import random
+import time
+
+import musysim
+import optimiser
+from devices import devices
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EXAMPLES = os.path.join(HERE, 'examples')
+PAPER_TESTS = os.path.join(HERE, 'tests', 'test_musys.py')
+MAX_STEPS = 200000
+
+
+def final_state(musys, error=None):
+    """The state of a finished run of musys, as compared between runs."""
+    return {
+        'EXP': musys.EXP,
+        'variables': musys.variables,
+        'stdout': musys.stdout.getvalue(),
+        'buses': [(b.data, b.buffer) for b in musys.buses],
+        'steps': musys.steps,
+        'error': error,
+    }
+
+
+def run(source, input_, engine, seed, max_steps=MAX_STEPS, optimise=False):
+    """Run source with engine, returning (final state, seconds taken)."""
+    musysim.EXPRESSIONS.clear()
+    musysim.DECODED.clear()
+    random.seed(seed)
+    musys = musysim.Compiler(source, input_, stdout=io.StringIO(), engine=engine)
+    if optimise:
+        optimiser.optimise(musys)
+    error = None
+    t = time.perf_counter()
+    try:
+        musys.run(max_steps)
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    t = time.perf_counter() - t
+    return final_state(musys, error), t
+
+
+def compare(source, input_=None, seed=0, max_steps=MAX_STEPS):
+    """
+    Run source with both engines.
+    Returns (names of any differing parts of the state, reference seconds, fast seconds).
+    """
+    reference, t_reference = run(source, input_, 'reference', seed, max_steps)
+    fast, t_fast = run(source, input_, 'fast', seed, max_steps)
+    differences = [k for k in reference if reference[k] != fast[k]]
+    return differences, t_reference, t_fast
+
+
+def example_programs():
+    """Yield (name, source, input) for each example program."""
+    with open(os.path.join(EXAMPLES, 'sample01.data')) as f:
+        data = f.read()
+    for path in sorted(glob.glob(os.path.join(EXAMPLES, '*.musys'))):
+        with open(path) as f:
+            yield os.path.basename(path), f.read(), data
+
+
+def paper_programs():
+    """Yield (name, source, None) for each constant `code = ...` in the paper tests."""
+    with open(PAPER_TESTS) as f:
+        tree = ast.parse(f.read())
+    for func in tree.body:
+        if not isinstance(func, ast.FunctionDef):
+            continue
+        for node in ast.walk(func):
+            if (isinstance(node, ast.Assign) and [getattr(t, 'id', None) for t in node.targets] == ['code']
+                    and isinstance(node.value, ast.Constant)):
+                yield func.name, node.value.value, None
+
+
+class RandomProgram:
+    """
+    Generator of random MUSYS programs that always terminate:
+    repeat counts are small constants, macros are not recursive
+    and every goto jumps forward.
+    """
+    variables = 'ABCDEF'
+    devices = [d for d in devices if d != 'T3']
+
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+
+    def item(self):
+        r = self.rng.random()
+        if r < 0.45:
+            return str(self.rng.randint(0, 99))
+        if r < 0.9:
+            return self.rng.choice(self.variables)
+        return '←'
+
+    def expr(self, params=''):
+        parts = [self.item() if not params or self.rng.random() < 0.7 else '%' + self.rng.choice(params)]
+        for _ in range(self.rng.randint(0, 3)):
+            op = self.rng.choice('+-*/&<>')
+            parts.append(op + (str(self.rng.randint(1, 9)) if op == '/' else self.item()))
+        if self.rng.random() < 0.1:
+            parts.append('↑')
+        return ''.join(parts)
+
+    def statement(self, depth, params='', in_macro=False):
+        rng = self.rng
+        kinds = ['assign', 'assign', 'expr', 'print', 'string', 'output', 'output', 'bus', 'para']
+        if depth:
+            kinds += ['cond', 'cond', 'repeat']
+        if in_macro:
+            kinds += ['return']
+        kind = rng.choice(kinds)
+        if kind == 'assign':
+            return f'{rng.choice(self.variables)}={self.expr(params)}'
+        if kind == 'expr':
+            return self.expr(params)
+        if kind == 'print':
+            return self.expr(params) + '\\'
+        if kind == 'string':
+            text = ''.join(rng.choice('ABCDEFG ,.') for _ in range(rng.randint(0, 12)))
+            return f'{rng.randint(0, 1)}"{text}"'
+        if kind == 'output':
+            if rng.random() < 0.5:
+                return f'{rng.choice(self.devices)}.{self.expr(params)}.'
+            return f'{self.expr(params)}:'
+        if kind == 'bus':
+            return f'{rng.randint(1, 6)}!'
+        if kind == 'para':
+            return '←' + rng.choice('ABC')
+        if kind == 'cond':
+            return f'{self.expr(params)}[{self.statements(depth - 1, params, in_macro)}]'
+        if kind == 'repeat':
+            return f'{rng.randint(1, 4)}({self.statements(depth - 1, params, in_macro)})'
+        return f'{self.expr(params)}[@]'
+
+    def statements(self, depth, params='', in_macro=False):
+        return ' '.join(self.statement(depth, params, in_macro) for _ in range(self.rng.randint(1, 4)))
+
+    def call(self, name, params=''):
+        args = ', '.join(self.expr(params) for _ in range(2))
+        return f'#{name} {args};'
+
+    def source(self):
+        rng = self.rng
+        lines = ['←A']
+        number = 0
+        numbers, targets = set(), set()
+        for _ in range(rng.randint(3, 10)):
+            line = self.statements(2)
+            if rng.random() < 0.3:
+                number += rng.randint(1, 5)
+                numbers.add(number)
+                line = f'{number} {line}'
+            if rng.random() < 0.2:
+                target = number + rng.randint(1, 5)
+                targets.add(target)
+                line += f' {self.expr()}[G{target}]'
+            if rng.random() < 0.3:  # a macro call must be the last thing on its line
+                line += ' ' + self.call(rng.choice(['MA', 'MB']))
+            lines.append(line)
+        for target in sorted(targets - numbers):  # after every goto, so still forward
+            lines.append(f'{target} 0')
+        macros = [
+            f'MA {self.statements(2, "AB", True)}',
+            f'MB {self.statements(1, "AB", True)}\n{self.call("MA", "AB")}',
+        ]
+        return '\n'.join(lines) + '\n$\n' + ' @\n'.join(macros) + ' @\n'
+
+    def input(self):
+        return '\n\n'.join(' '.join(str(self.rng.randint(0, 63)) for _ in range(300)) for _ in 'ABC')
+
+
+def random_programs(count, seed=0):
+    """Yield (name, source, input) for count random programs."""
+    for n in range(seed, seed + count):
+        program = RandomProgram(n)
+        yield f'random-{n}', program.source(), program.input()
+
+
+def programs(count=100, seed=0):
+    """All programs for the conformance check, as (name, source, input)."""
+    yield from example_programs()
+    yield from paper_programs()
+    yield from random_programs(count, seed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the MUSYSim reference and fast engines.")
+    parser.add_argument('-n', '--random', help='number of random programs to generate', type=int, default=100)
+    parser.add_argument('-s', '--seed', help='seed of the first random program', type=int, default=0)
+    parser.add_argument('--max-steps', help='limit on the steps each program runs for', type=int, default=MAX_STEPS)
+    parser.add_argument('-v', '--verbose', help='print the source of any program that differs', action='store_true')
+    args = parser.parse_args()
+
+    failures = 0
+    total_reference = total_fast = 0
+    for name, source, input_ in programs(args.random, args.seed):
+        differences, t_reference, t_fast = compare(source, input_, args.seed, args.max_steps)
+        total_reference += t_reference
+        total_fast += t_fast
+        status = 'DIFFERS: ' + ', '.join(differences) if differences else 'OK'
+        print(f'{name:32} {t_reference:8.4f}s {t_fast:8.4f}s {t_reference / t_fast:5.1f}x  {status}')
+        if differences:
+            failures += 1
+            if args.verbose:
+                print(source)
+    print(f'{"TOTAL":32} {total_reference:8.4f}s {total_fast:8.4f}s {total_reference / total_fast:5.1f}x  {failures} differ')
+    raise SystemExit(1 if failures else 0)
@@ -0,0 +1,491 @@
+"""
+Lockstep execution of one MUSYS program over many lanes, for musysim.batch().
+
+Lanes whose control flow agrees are run together as a Group, which decodes
+and dispatches each token once for all its lanes, keeping EXP and the
+variables as columns of one value per lane.
+
+When lanes diverge, at a [ condition, a repeat count, the end of a repeat
+or a call of a macro with different actual parameters, their Group is
+split. Each part is masked out of the others, and the part furthest behind
+in the program runs first, until the parts reach the same point again,
+e.g. the end of the condition or the loop, and are merged. Expressions
+that can not be evaluated for all lanes at once, e.g. because a lane would
+divide by zero, are evaluated by each lane's own Compiler.
+
+A lane that stays on its own for too long falls back to running alone with
+its own engine, as do all the lanes once they have diverged so far that
+each step runs fewer than MIN_WIDTH lanes on average.
+
+Every lane gives the same results, including steps and errors, as
+running it on its own with Compiler.run().
+"""
+
+from heapq import heappop, heappush
+from itertools import count
+
+from musysim import MAX, OPERATORS, RE_BRACKETS, WIDTHS, Macro, Pointer, StepLimitExceeded, decode, describe, max_signed
+
+
+FALLBACK_STEPS = 1000  # steps a group of one lane runs alone before it falls back to its own engine
+WINDOW = 2000  # group steps between checks that running in lockstep is paying off
+MIN_WIDTH = 16  # fewest lanes run by each group step, on average, for it to pay off
+SPLIT = object()  # step() result: the token did not run for g, which was split or lost its lanes
+END = (float('inf'),)  # sorts after every position in the program
+
+LOW, HIGH = -MAX // 2, MAX // 2
+DIVIDE = OPERATORS['/']
+VECTOR = {  # operator: function of the EXP and item columns, as OPERATORS for each lane
+    OPERATORS['+']: lambda E, X: [e + x for e, x in zip(E, X)],
+    OPERATORS['-']: lambda E, X: [e - x for e, x in zip(E, X)],
+    OPERATORS['*']: lambda E, X: [e * x for e, x in zip(E, X)],
+    OPERATORS['/']: lambda E, X: [e // x for e, x in zip(E, X)],
+    OPERATORS['&']: lambda E, X: [e & x & MAX for e, x in zip(E, X)],
+    OPERATORS['>']: lambda E, X: [max(e, x) for e, x in zip(E, X)],
+    OPERATORS['<']: lambda E, X: [min(e, x) for e, x in zip(E, X)],
+}
+
+
+class Group:
+    """
+    Lanes at the same point in the program.
+    The Pointer is shared, except that its repeat counters, at every depth,
+    are lists of one counter per lane.
+    """
+    __slots__ = ('lanes', 'EXP', 'variables', 'unset', 'pointer', 'state', 'nest', 'base', 'offsets', 'top', 'alone')
+
+    def __init__(self, lanes, pointer):
+        self.lanes = lanes  # Compilers, holding all other state of each lane
+        self.EXP = [0] * len(lanes)
+        self.variables = {}  # name: column of values
+        self.unset = {}  # name: indexes of lanes that have not assigned the variable
+        self.pointer = pointer
+        self.state = None
+        self.nest = 0
+        self.base = 0  # steps of every lane are base + offset
+        self.offsets = [0] * len(lanes)
+        self.top = 0  # largest offset
+        self.alone = 0  # steps run as a single lane
+
+    def key(self):
+        """Control state: Groups with the same key can be merged."""
+        p = self.pointer
+        frames = tuple((p._l[d], p._c[d], p._obj[d], p._values[d] and tuple(p._values[d])) for d in range(p.depth))
+        return frames, p.l, p.c, p.obj, p.values and tuple(p.values), self.state, self.nest
+
+    def position(self):
+        """Position in the program, to run the Group furthest behind first."""
+        p = self.pointer
+        return [(p._l[d], p._c[d]) for d in range(p.depth)] + [(p.l, p.c), END]
+
+    def select(self, indexes):
+        """Return a new Group of the lanes at indexes."""
+        other = Group([self.lanes[i] for i in indexes], copy_pointer(self.pointer, lambda n: [n[i] for i in indexes]))
+        other.EXP = [self.EXP[i] for i in indexes]
+        other.variables = {name: [column[i] for i in indexes] for name, column in self.variables.items()}
+        for name, unset in self.unset.items():
+            unset = {j for j, i in enumerate(indexes) if i in unset}
+            if unset:
+                other.unset[name] = unset
+        other.state, other.nest = self.state, self.nest
+        other.base = self.base
+        other.offsets = [self.offsets[i] for i in indexes]
+        other.top = max(other.offsets)
+        return other
+
+    def keep(self, indexes):
+        """Keep only the lanes at indexes."""
+        other = self.select(indexes)
+        for name in Group.__slots__:
+            setattr(self, name, getattr(other, name))
+
+    def merge(self, other):
+        """Add the lanes of other, which has the same key()."""
+        n, m = len(self.lanes), len(other.lanes)
+        for name in set(self.variables) | set(other.variables):
+            a, b = self.variables.get(name), other.variables.get(name)
+            unset = set(range(n)) if a is None else set(self.unset.get(name, ()))
+            unset |= set(range(n, n + m)) if b is None else {n + i for i in other.unset.get(name, ())}
+            self.variables[name] = (a or [0] * n) + (b or [0] * m)
+            if unset:
+                self.unset[name] = unset
+            else:
+                self.unset.pop(name, None)
+        self.lanes = self.lanes + other.lanes
+        self.EXP = self.EXP + other.EXP
+        self.offsets = self.offsets + [o + other.base - self.base for o in other.offsets]
+        self.top = max(self.offsets)
+        p, q = self.pointer, other.pointer
+        for d in range(p.depth):
+            p._counter[d] = p._counter[d] + q._counter[d]
+        p.counter = p.counter + q.counter
+        self.alone = 0
+
+
+def copy_pointer(pointer, counters, main=None):
+    """
+    Copy pointer, with each repeat counter n replaced by counters(n),
+    and the main program run by the Compiler main, if given.
+    """
+    def obj(o):
+        return o if main is None or o is None or isinstance(o, Macro) else main
+
+    other = Pointer(obj(pointer.obj))
+    other.l, other.c, other.routine, other.values = pointer.l, pointer.c, pointer.routine, pointer.values
+    other.counter = counters(pointer.counter)
+    other.depth = d = pointer.depth
+    other._l, other._c = list(pointer._l), list(pointer._c)
+    other._routine, other._values = list(pointer._routine), list(pointer._values)
+    other._obj = [obj(o) for o in pointer._obj]
+    other._counter = [counters(n) if i < d else 0 for i, n in enumerate(pointer._counter)]
+    return other
+
+
+class Lockstep:
+    """Runs the spawned lanes of a parsed template Compiler in lockstep Groups."""
+
+    def __init__(self, template, lanes, max_steps=None, fallback_steps=FALLBACK_STEPS):
+        self.template = template
+        self.max_steps = max_steps
+        self.fallback_steps = fallback_steps
+        self.new = []  # Groups made by the last step, waiting to be scheduled
+        self.steps = self.lane_steps = 0  # group steps, and lanes they ran, since the last check
+        if lanes:
+            pointer = Pointer(template)
+            pointer.counter = [1] * len(lanes)
+            self.new.append(Group(list(lanes), pointer))
+
+    def run(self):
+        """Run every lane to the end of the program, or until it fails."""
+        heap = []  # (position, n, key, Group) of each waiting Group, furthest behind first
+        waiting = {}  # key: Group
+        order = count()
+        while True:
+            if self.steps >= WINDOW:
+                if self.lane_steps < MIN_WIDTH * self.steps:  # lanes have diverged, run each alone
+                    for g in self.new + [g for _, _, key, g in heap if waiting.get(key) is g]:
+                        self.fallback(g, range(len(g.lanes)))
+                    return
+                self.steps = self.lane_steps = 0
+            for g in self.new:
+                if not g.lanes:
+                    continue
+                key = g.key()
+                other = waiting.get(key)
+                if other is not None:
+                    other.merge(g)
+                else:
+                    waiting[key] = g
+                    heappush(heap, (g.position(), next(order), key, g))
+            self.new = []
+            while heap:
+                _, _, key, g = heappop(heap)
+                if waiting.get(key) is g:  # otherwise it has since been merged
+                    del waiting[key]
+                    break
+            else:
+                return
+            behind = heap[0][0] if heap else None
+            while self.run_step(g) and not self.new:
+                if len(g.lanes) == 1:
+                    g.alone += 1
+                    if g.alone > self.fallback_steps:
+                        self.fallback(g, [0])
+                        break
+                if behind is not None and (g.key() in waiting or g.position() > behind):
+                    break
+            self.new.append(g)
+
+    def run_step(self, g):
+        """Run and count one step of g. False if g was split, or has no lanes left running."""
+        self.steps += 1
+        self.lane_steps += len(g.lanes)
+        try:
+            result = self.step(g)
+        except Exception as e:  # from the shared control flow, so the same for every lane
+            self.finish(g, {i: e for i in range(len(g.lanes))})
+            return False
+        return result is not SPLIT and self.after(g, result)
+
+    def after(self, g, result):
+        """Count the step just run, as Compiler.run() does. False if no lanes of g are left running."""
+        if not result:
+            self.finish(g, {i: None for i in range(len(g.lanes))})
+            return False
+        g.base += 1
+        if self.max_steps is not None and g.base + g.top >= self.max_steps:
+            error = StepLimitExceeded(f'Program did not finish within {self.max_steps} steps.')
+            self.finish(g, {i: error for i, o in enumerate(g.offsets) if g.base + o >= self.max_steps})
+        return bool(g.lanes)
+
+    def store(self, g, i):
+        """Store the state of lane i of g in its Compiler."""
+        lane = g.lanes[i]
+        lane.EXP = g.EXP[i]
+        lane.variables = {name: column[i] for name, column in g.variables.items() if i not in g.unset.get(name, ())}
+        lane.steps = g.base + g.offsets[i]
+        lane.state, lane.nest = g.state, g.nest
+        lane.pointer = copy_pointer(g.pointer, lambda n: n[i], lane)
+        return lane
+
+    def remove(self, g, indexes):
+        """Remove the lanes at indexes from g, leaving it with no lanes if they are all removed."""
+        keep = [i for i in range(len(g.lanes)) if i not in indexes]
+        if keep:
+            g.keep(keep)
+        else:
+            g.lanes = []
+
+    def finish(self, g, errors):
+        """Finish the lanes of g that are keys of errors, with their error (or None)."""
+        for i, error in errors.items():
+            lane = self.store(g, i)
+            lane.error = error and describe(error)
+        self.remove(g, errors)
+
+    def fallback(self, g, indexes):
+        """Run the lanes of g at indexes on their own, from the current position."""
+        for i in indexes:
+            lane = self.store(g, i)
+            try:
+                lane.run(self.max_steps)
+            except Exception as e:
+                lane.error = describe(e)
+        self.remove(g, set(indexes))
+
+    def split(self, g, parts):
+        """
+        Replace g by a Group for each list of lane indexes in parts, each of which
+        runs the token that split g straight away, so they are not merged again before.
+        """
+        for indexes in parts:
+            part = g.select(indexes)
+            self.run_step(part)
+            self.new.append(part)
+        g.lanes = []
+        return SPLIT
+
+    def vector(self, g, codes):
+        """
+        True if the compiled expressions codes can be evaluated for all lanes of g
+        at once: they have no items that need Compiler.expr_evaluate() or get_val(),
+        and no lane would fail, by dividing by zero or running out of data.
+        """
+        reads = 0
+        for _, parts in codes:
+            if parts is None:
+                return False
+            for kind, op, arg in parts:
+                if kind == 'val':
+                    return False
+                reads += kind == 'read'
+                if op is DIVIDE and (arg == 0 if kind == 'const' else 0 in g.variables.get(arg, (0,))):
+                    return False
+        if reads:
+            for lane in g.lanes:
+                values = lane.paragraphs.get(lane.paragraph)
+                if values is None or lane.cursors.get(lane.paragraph, 0) + reads > len(values):
+                    return False
+        return True
+
+    def evaluate(self, g, codes):
+        """
+        Evaluate compiled expressions codes with each lane's own Compiler.
+        A lane that fails is finished, with its error. Returns a column of values for each code.
+        """
+        columns, errors = [[] for _ in codes], {}
+        E = g.EXP = list(g.EXP)  # columns are shared, e.g. by a variable assigned from EXP
+        for i, lane in enumerate(g.lanes):
+            lane.EXP, lane.pointer = E[i], g.pointer  # for any %(...) parameter of the current macro
+            lane.variables = {name: column[i] for name, column in g.variables.items() if i not in g.unset.get(name, ())}
+            try:
+                for column, code in zip(columns, codes):
+                    column.append(lane.run_expression(code))
+            except Exception as e:
+                errors[i] = e
+                for column in columns:
+                    column += [0] * (i + 1 - len(column))
+            E[i] = lane.EXP
+        if errors:
+            self.finish(g, errors)
+            keep = [i for i in range(len(columns[0])) if i not in errors]
+            columns = [[column[i] for i in keep] for column in columns]
+        return columns
+
+    def expression(self, g, code):
+        """Evaluate a compiled expression for every lane, as Compiler.run_expression() does."""
+        E, n = g.EXP, len(g.lanes)
+        for kind, op, arg in code[1]:
+            if kind == 'const':
+                X = [arg] * n
+            elif kind == 'var':
+                X = g.variables.get(arg) or [0] * n
+            elif kind == 'rand':
+                E = [lane.mrand(e) for lane, e in zip(g.lanes, E)]
+                continue
+            else:  # read
+                E = [lane.read_data() for lane in g.lanes]
+                continue
+            E = X if op is None else VECTOR[op](E, X)
+        E = g.EXP = [e if LOW <= e <= HIGH else max_signed(e) for e in E]
+        return E
+
+    def clip(self, g, c, end):
+        """Limit a run of symbols from c to end to the steps left for any lane of g."""
+        if self.max_steps is not None:
+            return min(end, c + max(1, self.max_steps - g.base - g.top))
+        return end
+
+    def skip(self, g, c, end):
+        g.base += end - c - 1
+        return g.pointer.advance(end - c)
+
+    def step(self, g):
+        """Evaluate one step for every lane of g, as Compiler.evaluate_fast() does."""
+        pointer = g.pointer
+        l, c = pointer.l, pointer.c
+        if pointer.obj is self.template:
+            if l >= len(self.template.main_program):
+                return False
+            routine = self.template.main_program[l]
+        else:
+            routine = pointer.routine
+
+        symbol = routine[c]
+
+        if g.state == 'FCOND':  # in False condition, skip to the closing ]
+            end, nest = c, g.nest
+            while nest:
+                m = RE_BRACKETS.search(routine, end)
+                if m is None:
+                    end = len(routine)
+                    break
+                end = m.end()
+                nest += 1 if m.group() == '[' else -1
+            end = self.clip(g, c, end)
+            g.nest += routine.count('[', c, end) - routine.count(']', c, end)
+            if g.nest == 0:
+                g.state = None
+            return self.skip(g, c, end)
+
+        if g.state == 'STRING' or symbol == '"':  # Strings comment / STDOUT
+            start = c if g.state == 'STRING' else c + 1
+            g.state = 'STRING'
+            close = routine.find('"', start)
+            end = self.clip(g, c, len(routine) if close < 0 else close + 1)
+            text = None
+            if end > close >= 0:
+                g.state = None
+                text = routine[start:close] + '\n'
+            elif end > start:
+                text = routine[start:end]
+            if text:
+                for lane, e in zip(g.lanes, g.EXP):
+                    if e:
+                        print(text, end='', file=lane.stdout)
+            return self.skip(g, c, end)
+
+        kind, end, arg = decode(routine, c)
+        if kind == 'skip':
+            return self.skip(g, c, self.clip(g, c, end))
+        elif kind in ('expr', 'assign', 'macro'):
+            codes = [arg] if kind == 'expr' else [arg[1]] if kind == 'assign' else arg and arg[1]
+            if codes is None:  # not decoded, so fails
+                self.fallback(g, range(len(g.lanes)))
+                return SPLIT
+            if self.vector(g, codes):
+                columns = [self.expression(g, code) for code in codes]
+            else:
+                columns = self.evaluate(g, codes)
+                if not g.lanes:
+                    return SPLIT
+            if kind == 'assign':
+                g.variables[arg[0]] = columns[0]
+                g.unset.pop(arg[0], None)
+            elif kind == 'macro':
+                return self.call_macro(g, arg, columns)
+        elif kind == 'device':
+            for lane in g.lanes:
+                lane.buffer = arg
+        elif kind == 'output':
+            errors = {}
+            for i, (lane, e) in enumerate(zip(g.lanes, g.EXP)):
+                output = lane.buffer if lane.buffer is not None else e
+                if arg == '!':
+                    lane.bus = output
+                    continue
+                try:
+                    lane.output(output, WIDTHS[arg])
+                except Exception as error:
+                    errors[i] = error
+                    continue
+                lane.buffer = None
+            if errors:  # those lanes stop, the rest carry on
+                self.finish(g, errors)
+                if not g.lanes:
+                    return SPLIT
+        elif kind == 'print':
+            for lane, e in zip(g.lanes, g.EXP):
+                print(e, file=lane.stdout)
+        elif kind == 'cond':
+            E = [e if LOW <= e <= HIGH else max_signed(e) for e in g.EXP]  # not idempotent, so only once
+            positive = [i for i, e in enumerate(E) if e > 0]
+            if len(positive) not in (0, len(g.lanes)):
+                return self.split(g, [positive, [i for i, e in enumerate(E) if e <= 0]])
+            g.EXP = E
+            if not positive:
+                g.state = 'FCOND'
+                g.nest += 1
+        elif kind == 'repeat':
+            zero = [i for i, e in enumerate(g.EXP) if e == 0]
+            if len(zero) not in (0, len(g.lanes)):  # a repeat count of 0 restarts the routine
+                return self.split(g, [zero, [i for i, e in enumerate(g.EXP) if e != 0]])
+            pointer.push(pointer.obj, 0 if zero else 1)
+            pointer.counter = list(g.EXP)
+        elif kind == 'end':
+            counters = [n - 1 for n in pointer.counter]
+            done = [i for i, n in enumerate(counters) if not n]
+            if len(done) not in (0, len(g.lanes)):
+                return self.split(g, [done, [i for i, n in enumerate(counters) if n]])
+            pointer.counter = counters
+            if done:  # repeat finished, resume
+                pointer.pop()
+                pointer.l, pointer.c = l, c
+            else:
+                pointer.l = pointer._l[pointer.depth - 1]
+                pointer.c = pointer._c[pointer.depth - 1]
+        elif kind == 'return':
+            pointer.pop()
+            return pointer.advance()
+        elif kind == 'goto':
+            return pointer.goto(arg)
+        elif kind == 'paragraph':
+            for lane in g.lanes:
+                lane.paragraph = arg
+        return g.pointer.advance(end - c)
+
+    def call_macro(self, g, arg, columns):
+        """
+        Start running a macro with the columns of actual parameters,
+        splitting g into a Group for each different list of parameters.
+        """
+        name, _, length = arg
+        g.pointer.advance(length)
+        macro = self.template.macros[name]
+        parts = {}
+        for i, values in enumerate(zip(*columns) if columns else [()] * len(g.lanes)):
+            parts.setdefault(values, []).append(i)
+        (values, indexes), *rest = parts.items()
+        for other_values, other_indexes in rest:
+            part = g.select(other_indexes)
+            self.push(part, macro, list(other_values))
+            self.after(part, macro)
+            self.new.append(part)
+        if rest:
+            g.keep(indexes)
+        self.push(g, macro, list(values))
+        return macro
+
+    def push(self, g, macro, values):
+        g.pointer.push(macro, 0, macro.call(values), values)
+        g.pointer.counter = [0] * len(g.lanes)
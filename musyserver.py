@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Persistent compile server for MUSYSim.
+
+Keeps a pool of pre-warmed worker processes with musysim and sofkasim
+already imported, so short jobs avoid the interpreter start-up cost.
+
+POST a JSON object to http://HOST:PORT/run:
+
+    {"source": "<MUSYS source>", "input": "<datafile contents>",
+     "render": false, "max_steps": 100000, "engine": "fast"}
+
+Only "source" is required. The response is a JSON object:
+
+    {"stdout": "...", "exp": 0, "variables": {...},
+     "buses": [[octal words of bus 1], ..., [bus 6]],
+     "output": "<Nyquist code if render was requested>",
+     "error": null}
+
+Requests beyond the worker pool and queue capacity are rejected with
+503 Service Unavailable rather than queued indefinitely.
+"""
+
+import argparse
+import io
+import json
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from musysim import ENGINES, Compiler, StepLimitExceeded
+from sofkasim import PRELUDE, Sofka
+
+
+DEFAULT_PORT = 8073
+MAX_STEPS = 1000000  # per request limit on evaluated symbols
+MAX_SOURCE = 64 * 1024  # per request limit on source + input size, in characters
+TIMEOUT = 30  # seconds to wait for a worker result
+BODY_BYTES = 12  # most bytes a character of source or input takes in a request, as a JSON surrogate pair escape
+
+
+def warm():
+    """Worker initializer: run a small program so the first real job is fast."""
+    for engine in ENGINES:
+        compile_job('#NOTE 56, 12, 15; $ NOTE O1.%A. A1.%B. T1.%C-1. @', render=True, engine=engine)
+
+
+def compile_job(source, input_=None, render=False, max_steps=MAX_STEPS, engine='reference'):
+    """Compile and run a MUSYS program, returning the results as a dict."""
+    stdout = io.StringIO()
+    result = {'stdout': '', 'exp': None, 'variables': {}, 'buses': [], 'output': None, 'error': None}
+    try:
+        musys = Compiler(source, input_, stdout=stdout, engine=engine)
+        musys.run(max_steps)
+        result['exp'] = musys.EXP
+        result['variables'] = musys.variables
+        result['buses'] = [b.data for b in musys.buses]
+        if render:
+            result['output'] = f'{PRELUDE}(play {Sofka(musys.lists()).perform()})'
+    except StepLimitExceeded as e:
+        result['error'] = str(e)
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    result['stdout'] = stdout.getvalue()
+    return result
+
+
+class Server(ThreadingHTTPServer):
+    """HTTP server dispatching jobs to a bounded pool of worker processes."""
+    daemon_threads = True
+
+    def __init__(self, address, workers=None, queue=16, max_steps=MAX_STEPS, max_source=MAX_SOURCE, timeout=TIMEOUT):
+        super().__init__(address, Handler)
+        workers = workers or os.cpu_count() or 1
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=warm)
+        for job in [self.pool.submit(int) for _ in range(workers)]:  # start and warm every worker now
+            job.result()
+        self.slots = threading.BoundedSemaphore(workers + queue)  # running + waiting jobs
+        self.max_steps = max_steps
+        self.max_source = max_source
+        self.timeout = timeout
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(cancel_futures=True)
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != '/run':
+            return self.reply(404, {'error': f'Unknown path {self.path}'})
+        server = self.server
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length < 0:
+                raise ValueError(f'Content-Length {length}')
+            if length > BODY_BYTES * server.max_source + 1024:  # and 1024 bytes for the other fields
+                return self.reply(413, {'error': f'Source and input exceed {server.max_source} characters.'})
+            request = json.loads(self.rfile.read(length))
+            source = request['source']
+            input_ = request.get('input')
+            render = bool(request.get('render', False))
+            max_steps = min(int(request.get('max_steps', server.max_steps)), server.max_steps)
+            engine = request.get('engine', 'reference')
+            if engine not in ENGINES:
+                raise ValueError(f'unknown engine {engine!r}')
+            if not isinstance(source, str) or not isinstance(input_, (str, type(None))):
+                raise TypeError('source and input must be strings')
+        except (ValueError, KeyError, TypeError) as e:
+            return self.reply(400, {'error': f'Bad request: {e}'})
+        if len(source) + len(input_ or '') > server.max_source:
+            return self.reply(413, {'error': f'Source and input exceed {server.max_source} characters.'})
+
+        if not server.slots.acquire(blocking=False):
+            return self.reply(503, {'error': 'Server busy, try again later.'}, {'Retry-After': '1'})
+        try:
+            future = server.pool.submit(compile_job, source, input_, render, max_steps, engine)
+        except RuntimeError as e:  # pool shut down
+            server.slots.release()
+            return self.reply(503, {'error': str(e)})
+        # A job keeps its slot until its worker is done with it, even if we stop waiting.
+        future.add_done_callback(lambda f: server.slots.release())
+        try:
+            result = future.result(timeout=server.timeout)
+        except TimeoutError:
+            future.cancel()
+            return self.reply(504, {'error': f'No result within {server.timeout} seconds.'})
+        except Exception as e:  # worker process died
+            return self.reply(500, {'error': f'{type(e).__name__}: {e}'})
+        self.reply(422 if result['error'] else 200, result)
+
+    def reply(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MUSYS (1973) simulator compile server.")
+    parser.add_argument('--host', help='address to listen on', default='127.0.0.1')
+    parser.add_argument('-p', '--port', help='port to listen on', type=int, default=DEFAULT_PORT)
+    parser.add_argument('-w', '--workers', help='number of worker processes (default: CPU count)', type=int)
+    parser.add_argument('-q', '--queue', help='number of requests allowed to wait for a worker', type=int, default=16)
+    parser.add_argument('--max-steps', help='per request limit on evaluated symbols', type=int, default=MAX_STEPS)
+    parser.add_argument('--max-source', help='per request limit on source + input characters', type=int, default=MAX_SOURCE)
+    parser.add_argument('--timeout', help='seconds to wait for each result', type=float, default=TIMEOUT)
+    args = parser.parse_args()
+
+    server = Server((args.host, args.port), args.workers, args.queue, args.max_steps, args.max_source, args.timeout)
+    print(f'[Serving MUSYS on http://{args.host}:{server.server_address[1]}/run ...]')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
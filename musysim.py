@@ -4,9 +4,14 @@ https://esolangs.org/wiki/MUSYS simulator
 """
 
 import argparse
+import hashlib
+import json
+import os
 import re
+import zlib
+from io import StringIO
 from copy import copy
-from random import randint
+from random import Random, getrandbits
 
 from devices import devices
 
@@ -26,6 +31,41 @@ RE_DEVICE = re.compile(r'[A-Z][0-9]+')
 RE_GOTO = re.compile(r'G([0-9]+)')
 RE_MACRO = re.compile(r'#([A-Z]+)\s+(.*);')
 RE_PARAGRAPH_SELECT = re.compile(f'←[{ALPHA}]')
+RE_OUTPUT = re.compile(r'[.:!]')
+
+STACK_SIZE = 32  # initial Pointer stack depth, doubled whenever it fills up
+CACHE_SIZE = 4096  # most entries kept in each memo of expressions and macro expansions
+CHECKPOINT_EVERY = 100000  # default number of steps between snapshots of the run state
+SNAPSHOT_VERSION = 1
+WIDTHS = {'.': 6, ':': 12}  # bits output by each output symbol
+
+# Memos shared by all Compilers
+EXPRESSIONS = {}  # expression: its operator and item parts
+DECODED = {}  # routine: list of decoded tokens, by position, for the fast engine
+OCTAL = {6: {}, 12: {}}  # width: {value: octal string output}
+WORDS = {}  # first 6 bit octal string: {second: combined 12 bit word}
+
+OPERATORS = {
+        '+': lambda e, x: e + x,
+        '-': lambda e, x: e - x,
+        '*': lambda e, x: e * x,
+        '/': lambda e, x: e // x,
+        '&': lambda e, x: e & x & MAX,
+        '>': lambda e, x: max(e, x),
+        '<': lambda e, x: min(e, x),
+}
+
+# Token kinds, in the order Compiler.evaluate() checks for them
+SYMBOLS = {'"': 'string', '\\': 'print', '[': 'cond', '(': 'repeat', ')': 'end', '@': 'return'}
+TOKENS = [('goto', RE_GOTO), ('device', RE_DEVICE), ('output', RE_OUTPUT), ('assign', RE_ASSIGN),
+          ('paragraph', RE_PARAGRAPH_SELECT), ('expr', RE_EXPR)]
+STARTS = set(ALPHA + '0123456789←.:!')  # all symbols that can start one of the TOKENS
+RE_BRACKETS = re.compile(r'[\[\]]')
+
+ENGINES = {  # engine name: Compiler method evaluating one step
+    'reference': 'evaluate',
+    'fast': 'evaluate_fast',
+}
 
 
 def dprint(*s):
@@ -41,13 +81,109 @@ def max_signed(i):
     return -(i - signbit) if signbit else i
 
 
+def next_token(routine, c=0):
+    """
+    Return (kind, end, match) for the symbol at routine[c], using the same
+    rules as Compiler.evaluate() outside of strings and false conditions.
+    A string is returned as its opening '"' only.
+    """
+    symbol = routine[c]
+    if symbol in SYMBOLS:
+        return SYMBOLS[symbol], c + 1, None
+    if symbol == '#':
+        m = RE_MACRO.match(routine, c)
+        return 'macro', m.end() if m else c + 1, m
+    if symbol not in STARTS:
+        return 'skip', c + 1, None
+    for kind, regex in TOKENS:
+        m = regex.match(routine, c)
+        if m:
+            return kind, m.end(), m
+    return 'skip', c + 1, None
+
+
+def compile_expression(expression):
+    """
+    Compile an expression to (expression, parts) for Compiler.run_expression(),
+    where parts is a tuple of (kind, operator, argument) for each item,
+    or None if it must be evaluated by Compiler.expr_evaluate().
+    """
+    parts = []
+    op = None
+    for p in re.split(r'(\W)', expression):
+        if not p:
+            continue
+        if p in OPERATORS:
+            op = OPERATORS[p]
+        elif p == '%':  # macro formal parameter
+            return expression, None
+        elif p in '↑^':
+            parts.append(('rand', None, None))
+        elif p == '←':
+            parts.append(('read', None, None))
+        elif p.isdecimal():
+            parts.append(('const', op, int(p)))
+        elif '_' in p or re.search(r'[+&<>^_*/-]', p):
+            parts.append(('val', op, p))
+        else:
+            parts.append(('var', op, p))
+    return expression, tuple(parts)
+
+
+def decode(routine, c):
+    """
+    Return the (kind, end, argument) of the token at routine[c] for Compiler.evaluate_fast(),
+    where argument is the token's pre-parsed content. Memoised for each routine.
+    """
+    tokens = DECODED.get(routine)
+    if tokens is None:
+        if len(DECODED) >= CACHE_SIZE:
+            DECODED.clear()
+        tokens = DECODED[routine] = [None] * len(routine)
+    token = tokens[c]
+    if token is None:
+        kind, end, m = next_token(routine, c)
+        arg = None
+        if kind == 'skip':
+            while end < len(routine) and routine[end] != '"' and next_token(routine, end)[0] == 'skip':
+                end += 1
+        elif kind in ('expr', 'device'):
+            arg = compile_expression(m.group()) if kind == 'expr' else m.group()
+        elif kind == 'assign':
+            arg = (m.group(1), compile_expression(m.group(2)))
+        elif kind == 'macro' and m:
+            codes = tuple(compile_expression(p) for p in m.group(2).split(','))
+            arg = (m.group(1), codes, m.end() - m.start())
+        elif kind == 'goto':
+            arg = int(m.group(1))
+        elif kind in ('output', 'paragraph'):
+            arg = routine[end - 1]
+        token = tokens[c] = (kind, end, arg)
+    return token
+
+
 class Pointer():
+    """
+    Position in the running program, and a stack of positions to return to.
+    The stack is held in preallocated parallel lists, indexed by depth.
+    """
+    __slots__ = ('l', 'c', 'counter', 'obj', 'routine', 'values', 'depth',
+                 '_l', '_c', '_counter', '_obj', '_routine', '_values')
+
     def __init__(self, obj):
         self.l = 0  # line
         self.c = 0  # character
         self.counter = 1
-        self.obj = obj
-        self.stack = []
+        self.obj = obj  # the Compiler (main program) or Macro being run
+        self.routine = ''  # text of the macro being run
+        self.values = None  # actual parameters of the macro being run
+        self.depth = 0  # stack size
+        self._l = [0] * STACK_SIZE
+        self._c = [0] * STACK_SIZE
+        self._counter = [0] * STACK_SIZE
+        self._obj = [None] * STACK_SIZE
+        self._routine = [None] * STACK_SIZE
+        self._values = [None] * STACK_SIZE
 
     def advance(self, n=1):
         """Advance the pointer."""
@@ -58,7 +194,7 @@ class Pointer():
             chars = len(self.obj.main_program[self.l])
             lines = len(self.obj.main_program)
         else:
-            chars = len(self.obj.routine)
+            chars = len(self.routine)
             lines = 1
 
         if self.c >= chars:
@@ -76,13 +212,13 @@ class Pointer():
         """
         self.counter -= 1
         if not self.counter:
-            current = (self.l, self.c)
+            l, c = self.l, self.c
             self.pop()  # repeat finished, resume
-            self.l, self.c = current
+            self.l, self.c = l, c
             return True  # TODO: standardise these return values to something meaningful
         dprint('DECR', self.counter)
-        self.l = self.stack[-1][0]
-        self.c = self.stack[-1][1]
+        self.l = self._l[self.depth - 1]
+        self.c = self._c[self.depth - 1]
 
     def goto(self, lineno):
         self.c = 0
@@ -91,54 +227,157 @@ class Pointer():
         return self.l
 
     def pop(self):
-        self.obj.values = []
-        self.obj.routine = ''
-        loc = self.stack.pop()
-        self.l, self.c, self.obj, self.counter = loc
-        dprint('POINTER LOC:', loc)
+        if not self.depth:
+            raise IndexError('pop from empty stack')
+        d = self.depth = self.depth - 1
+        self.l, self.c, self.counter = self._l[d], self._c[d], self._counter[d]
+        self.obj, self.routine, self.values = self._obj[d], self._routine[d], self._values[d]
+        self._obj[d] = self._routine[d] = self._values[d] = None
+        dprint('POINTER LOC:', self)
         return self.obj
 
-    def push(self, obj, counter=0):
-        self.stack.append((self.l, self.c, self.obj, self.counter))
+    def push(self, obj, counter=0, routine=None, values=None):
+        """
+        Save the current position and start running obj.
+        A macro is pushed with its expanded routine and values,
+        a repeat loop continues in the current routine.
+        """
+        d = self.depth
+        if d == len(self._l):  # stack full, double its size
+            for stack in (self._l, self._c, self._counter, self._obj, self._routine, self._values):
+                stack.extend([None] * d)
+        self._l[d], self._c[d], self._counter[d] = self.l, self.c, self.counter
+        self._obj[d], self._routine[d], self._values[d] = self.obj, self.routine, self.values
+        self.depth = d + 1
         self.obj = obj
+        if routine is not None:
+            self.routine, self.values = routine, values
         if not counter:  # If this is a repeat loop, don't zero the position
             self.l = 0
             self.c = 0
         self.counter = counter
 
+    def frames(self):
+        """
+        The stack then the current position, as a list of [l, c, counter, macro name, values].
+        The macro name is None for the main program.
+        """
+        frames = [(self._l[d], self._c[d], self._counter[d], self._obj[d], self._values[d]) for d in range(self.depth)]
+        frames.append((self.l, self.c, self.counter, self.obj, self.values))
+        return [[l, c, counter, obj.name if isinstance(obj, Macro) else None, values]
+                for l, c, counter, obj, values in frames]
+
+    def load(self, frames, compiler):
+        """Restore the stack and current position from frames(), for the program run by compiler."""
+        self.depth = 0
+        for i, (l, c, counter, name, values) in enumerate(frames):
+            if i:
+                self.push(None)  # save the previous frame
+            if name is None:
+                self.obj, self.routine = compiler, ''
+            else:
+                self.obj = compiler.macros[name]
+                self.routine = self.obj.call(values)
+            self.l, self.c, self.counter, self.values = l, c, counter, values
+
     def __repr__(self):
-        return f'<Pointer> ({self.l}, {self.c}) Counter: {self.counter} ({str(self.obj)[:5]}) Stack size: {len(self.stack)}'
+        return f'<Pointer> ({self.l}, {self.c}) Counter: {self.counter} ({str(self.obj)[:5]}) Stack size: {self.depth}'
+
+
+class StepLimitExceeded(Exception):
+    """Raised when a program runs for more than its allowed number of steps."""
+
+
+def describe(error):
+    """One line description of an error that stopped a program."""
+    if isinstance(error, StepLimitExceeded):
+        return str(error)
+    return f'{type(error).__name__}: {error}'
 
 
 class Compiler():
-    buses = []
-    lines = {}
-    macros = {}
-    paragraphs = {}
-    variables = {}
-
-    def __init__(self, source, input_=None):
-        self.main_program, macros = re.split(r'\$', source.strip())
-        self.main_program = [line for line in self.main_program.split('\n') if line]
+    def __init__(self, source, input_=None, stdout=None, engine='reference', seed=None):
+        if engine not in ENGINES:
+            raise ValueError(f'Unknown engine {engine!r}, choose from: {", ".join(ENGINES)}')
+        self.engine = engine
+        self.max_steps = None
+        self.outfile = 'musys.out'
+        self.parsed_lines = {}  # source line: (line number or None, routine)
+        self.parsed_macros = {}  # source text: Macro
+        self.main_program = []
+        self.reload(source)
+        self.reset(input_, stdout, seed)
+
+    def reload(self, source):
+        """
+        Parse source, reusing the parse of any line or macro whose text has not changed
+        since the last parse (so a reused Macro keeps its memo of expansions).
+        Returns a list of descriptions of the lines and macros that changed.
+        Run state is not reset.
+        """
+        main_program, macros = re.split(r'\$', source.strip())
+        parsed_lines, parsed_macros, changes = {}, {}, []
+        program, lines = [], {}
+        for line in main_program.split('\n'):
+            if not line:
+                continue
+            parsed = self.parsed_lines.get(line)
+            if parsed is None:
+                # extract any line number
+                lineno = re.match(r'^([0-9]+)\s(.*)$', line)
+                parsed = (int(lineno.group(1)), lineno.group(2)) if lineno else (None, line)
+                changes.append(f'line {len(program) + 1}')
+            parsed_lines[line] = parsed
+            if parsed[0] is not None:
+                lines[parsed[0]] = len(program)
+            program.append(parsed[1])
+        for raw in re.split(r'\s*@\s+|@$', macros):
+            raw = raw.strip()
+            if not raw:
+                continue
+            macro = self.parsed_macros.get(raw)
+            if macro is None:
+                macro = Macro(raw)
+                changes.append(f'macro {macro.name}')
+            parsed_macros[raw] = macro
+        removed = len(self.main_program) - len(program)
+        changes += [f'{removed} line{"s" if removed > 1 else ""} removed'] if removed > 0 else []
+        self.main_program, self.lines = program, lines
+        self.macros = {m.name: m for m in parsed_macros.values()}
+        changes += [f'macro {name} removed' for name in {m.name for m in self.parsed_macros.values()} - set(self.macros)]
+        self.parsed_lines, self.parsed_macros = parsed_lines, parsed_macros
+        return changes
+
+    def reset(self, input_=None, stdout=None, seed=None):
+        """
+        Reset all run state, ready to run the parsed program from the start.
+        seed: for the random number generator, if None it is seeded from the random module.
+        """
+        self.buses = [Bus(i + 1) for i in range(6)]
+        self.paragraphs = {}
+        self.cursors = {}  # position of the next value to read in each paragraph
+        self.random = Random(getrandbits(64) if seed is None else seed)  # own state, so it can be checkpointed
+        self.variables = {}
+        self.stdout = stdout  # file for STDOUT output, None is sys.stdout
+        self.steps = 0  # number of symbols evaluated so far
         self.pointer = Pointer(self)
         self.store_input(input_)
         self.paragraph = None
         self.EXP = 0  # The expression register
         self.bus = 1  # Current output bus (1-6)
         self.buffer = None  # buffer for storing device codes
-        self.outfile = 'musys.out'
         self.state = None
         self.nest = 0  # used for tracking conditional nesting
+        self.error = None  # describe() of the error that stopped a batch() lane
 
-        for i in range(6):
-            self.buses.append(Bus(i + 1))
-        self.macros = {m.name: m for m in [Macro(m) for m in re.split(r'\s*@\s+|@$', macros) if m]}
-        # extract any line numbers
-        for i, block in enumerate(self.main_program):
-            lineno = re.match(r'^([0-9]+)\s(.*)$', block)
-            if lineno:
-                self.lines[int(lineno.group(1))] = i
-                self.main_program[i] = lineno.group(2)
+    def spawn(self, input_=None, stdout=None, seed=None):
+        """
+        Return a new Compiler for this already parsed program,
+        with its own run state, datafile input and STDOUT.
+        """
+        other = copy(self)
+        other.reset(input_, stdout, seed)
+        return other
 
     def __repr__(self):
         return """==MUSYS program==\n%s\n==Lines==\n%s\n==Macros==\n%s""" % (self.main_program, self.lines, '\n'.join([str(v) for m, v in self.macros.items()]))
@@ -165,8 +404,13 @@ class Compiler():
         """Read the next number from the current datafile paragraph."""
         # TODO: What happens when we have read all values in a paragraph?
         # TODO: Unsure whether these should be read destructively, does ←A reset the position in the
-        # paragraph back to 0? Destructive .pop(0) seems the easiest for now.
-        n = self.paragraphs[self.paragraph].pop(0)
+        # paragraph back to 0? For now each paragraph keeps its own read position.
+        values = self.paragraphs[self.paragraph]
+        i = self.cursors.get(self.paragraph, 0)
+        if i >= len(values):
+            raise IndexError(f'no more data in paragraph {self.paragraph}')
+        n = values[i]
+        self.cursors[self.paragraph] = i + 1
         # TODO: figure out whether this is supposed to be 6bit or 12bit & guard against overflows (assume 12bit for now)
         return n
 
@@ -184,18 +428,20 @@ class Compiler():
         if e == 0:
             return 0
         sign = e // abs(e)
-        return randint(1, abs(e)) * sign
+        return self.random.randint(1, abs(e)) * sign
 
     def get_val(self, symbol):
         # TODO: this should not be called by anything other than expr_evaluate()
         if not symbol:
             return 0
-        try:
-            return int(symbol)
-        except ValueError as e:
-            if re.search(r'[+&<>^_*/-]', symbol):
-                return self.expr_evaluate(symbol)
-            return self.variables.get(symbol, 0)
+        if symbol.isdecimal() or '_' in symbol:  # only these can be int()s, e.g. 12 or 1_000
+            try:
+                return int(symbol)
+            except ValueError:
+                pass
+        if re.search(r'[+&<>^_*/-]', symbol):
+            return self.expr_evaluate(symbol)
+        return self.variables.get(symbol, 0)
 
     def expr_evaluate(self, expression):
         """
@@ -207,29 +453,24 @@ class Compiler():
             4) ← (read input from current paragraph)
             Effect: updates EXP
         """
-        operators = {
-                '+': lambda e, x: e + x,
-                '-': lambda e, x: e - x,
-                '*': lambda e, x: e * x,
-                '/': lambda e, x: e // x,
-                '&': lambda e, x: e & x & MAX,
-                '>': lambda e, x: max(e, x),
-                '<': lambda e, x: min(e, x),
-        }
-        parts = [p for p in re.split(r'(\W)', expression) if p]
+        parts = EXPRESSIONS.get(expression)
+        if parts is None:
+            if len(EXPRESSIONS) >= CACHE_SIZE:
+                EXPRESSIONS.clear()
+            parts = EXPRESSIONS[expression] = tuple(p for p in re.split(r'(\W)', expression) if p)
         op = None
         for p in parts:
-            if p in operators.keys():
-                op = operators[p]
+            if p in OPERATORS:
+                op = OPERATORS[p]
             elif p == '%':
                 value = self.expr_evaluate(expression[2:-1]) - 1
-                dprint('MACRO formal parameter found:', p, expression, value, 'Macro:', self.pointer.obj.name, self.pointer.obj.values, self.pointer.obj.values[value])
-                self.EXP = self.pointer.obj.values[value]
+                dprint('MACRO formal parameter found:', p, expression, value, 'Macro:', self.pointer.obj.name, self.pointer.values, self.pointer.values[value])
+                self.EXP = self.pointer.values[value]
                 break
             elif p in '↑^':
                 self.EXP = self.mrand(self.EXP)
             elif p == '←':
-                dprint(f"READ VALUE!")
+                dprint("READ VALUE!")
                 self.EXP = self.read_data()
             elif op is None:
                 self.EXP = self.get_val(p)
@@ -242,7 +483,7 @@ class Compiler():
     def str_out(self, s):
         """Output a string / character if EXP is non-zero."""
         if self.EXP:
-            print(s, end='')
+            print(s, end='', file=self.stdout)
 
     def evaluate(self):
         """
@@ -250,15 +491,15 @@ class Compiler():
         "'routine' is used to denote a section of program that may use any MUSYS facilities provided
         that bracketing characters, (), [], "", '' are nested." (Grogono, 1973. p.373)
         """
-        l, c, o = self.pointer.l, self.pointer.c, self.pointer.obj
-        if o == self:
+        pointer = self.pointer
+        l, c = pointer.l, pointer.c
+        if pointer.obj is self:
             if l >= len(self.main_program):
                 return False
             routine = self.main_program[l]
         else:
-            routine = o.routine
-        routine = routine[c:]
-        symbol = routine[0]
+            routine = pointer.routine
+        symbol = routine[c]
         mov = 1  # number of symbols to advance after this read
 
         if self.state == 'FCOND':  # in False condition
@@ -268,90 +509,201 @@ class Compiler():
                 self.nest -= 1
             if self.nest == 0:
                 self.state = None
-            return self.pointer.advance()
-
-        if not self.state == 'STRING':  # Strings comment / STDOUT
-            m = RE_EXPR.match(routine)
-            dprint(f'ROUTINE: {routine} SYMBOL: <{symbol}>')
-            dprint(self.pointer)
+            return pointer.advance()
 
-        if self.state == 'STRING':
+        if self.state == 'STRING':  # Strings comment / STDOUT
             if symbol == '"':
                 self.state = None
                 self.str_out('\n')
             else:
                 self.str_out(symbol)
-        elif symbol == '"':
+            return pointer.advance()
+
+        if DEBUG:
+            dprint(f'ROUTINE: {routine[c:]} SYMBOL: <{symbol}>')
+            dprint(pointer)
+        kind, end, m = next_token(routine, c)
+        if kind == 'string':
             self.state = 'STRING'
-        elif symbol == '\\':  # print EXP to STDOUT
-            print(self.EXP)
-        elif symbol == '[':  # Conditional block
-            m = re.match(r'([^\[]*)\[(.*)\]', routine)
-            expr, subroutine = m.group(1, 2)
-            cond = self.expr_evaluate(expr) > 0
-            dprint(f"  COND {expr} ({cond}) => {subroutine}")
-
-            if not cond:
+        elif kind == 'print':  # print EXP to STDOUT
+            print(self.EXP, file=self.stdout)
+        elif kind == 'cond':  # Conditional block
+            self.EXP = max_signed(self.EXP)
+            dprint('  COND', self.EXP > 0)
+            if self.EXP <= 0:
                 self.state = 'FCOND'
                 self.nest += 1
-        elif symbol == '(':  # Repeat block
-            dprint('REPEAT FOUND!', routine, self.pointer)
-            self.pointer.push(self.pointer.obj, self.EXP)
-        elif symbol == ')':  # End of repeat block
-            dprint('END REPEAT FOUND!', routine, self.pointer)
-            self.pointer.decr_repeat()
-        elif symbol == '#':  # Macro
-            macro = self.call_macro(routine)
-            dprint(f'MACRO FOUND! {routine} => {macro.routine}')
-            self.pointer.push(macro)
-            return macro
-        #elif symbol in '] ':
-        #    pass
-        elif symbol == '@':  # Early return from macro
-            self.pointer.pop()
-        elif RE_GOTO.match(routine):  # GOTO
-            m = RE_GOTO.match(routine)
+        elif kind == 'repeat':  # Repeat block
+            dprint('REPEAT FOUND!', pointer)
+            pointer.push(pointer.obj, self.EXP)
+        elif kind == 'end':  # End of repeat block
+            dprint('END REPEAT FOUND!', pointer)
+            pointer.decr_repeat()
+        elif kind == 'macro':  # Macro
+            return self.call_macro(m)
+        elif kind == 'return':  # Early return from macro
+            pointer.pop()
+        elif kind == 'goto':  # GOTO
             dprint('GOTO', m.group(1))
-            return self.pointer.goto(int(m.group(1)))
-        elif RE_DEVICE.match(routine):  # device found
-            device = RE_DEVICE.match(routine).group(0)
-            self.buffer = device
-            dprint('DEVICE', device)
-            return self.pointer.advance(len(device))
-        elif symbol in '.:!':  # Send output to a list
-            widths = {'.': 6, ':': 12}
+            return pointer.goto(int(m.group(1)))
+        elif kind == 'device':  # device found
+            self.buffer = m.group()
+            dprint('DEVICE', self.buffer)
+            return pointer.advance(end - c)
+        elif kind == 'output':  # Send output to a list
             output = self.buffer if self.buffer is not None else self.EXP
             if symbol == '!':
                 self.bus = output
             else:
-                self.output(output, widths[symbol])
+                self.output(output, WIDTHS[symbol])
                 self.buffer = None
-        elif RE_ASSIGN.match(routine):  # Assignment
-            m = RE_ASSIGN.match(routine)
-            var, expr = m.group(1, 2)
-            self.assign(var, expr)
-            mov = len(m.group(0))
-            dprint('MOV', mov)
-        elif RE_PARAGRAPH_SELECT.match(routine):  # Select data paragraph
-            self.paragraph = routine[1]
-            dprint(f'SELECTING PARA {self.paragraph}!')
+        elif kind == 'assign':  # Assignment
+            self.assign(m.group(1), m.group(2))
+            mov = end - c
+        elif kind == 'paragraph':  # Select data paragraph
+            self.paragraph = routine[c + 1]
+            dprint('SELECTING PARA', self.paragraph)
             mov = 2
-        elif m:
-            expr = m.group()
-            dprint(f'EXPR FOUND: {expr}')
-            self.expr_evaluate(expr)
-            mov = len(expr)
+        elif kind == 'expr':
+            dprint('EXPR FOUND:', m.group())
+            self.expr_evaluate(m.group())
+            mov = end - c
 
-        return self.pointer.advance(mov)
+        return pointer.advance(mov)
 
+    def evaluate_fast(self):
+        """
+        Evaluates routine, giving the same results as evaluate().
+        Tokens are decoded once per routine and expressions compiled once, and
+        runs of blanks, strings and false conditions are each evaluated in one call.
+        """
+        pointer = self.pointer
+        l, c = pointer.l, pointer.c
+        if pointer.obj is self:
+            if l >= len(self.main_program):
+                return False
+            routine = self.main_program[l]
+        else:
+            routine = pointer.routine
+
+        symbol = routine[c]
+
+        if self.state == 'FCOND':  # in False condition, skip to the closing ]
+            end, nest = c, self.nest
+            while nest:
+                m = RE_BRACKETS.search(routine, end)
+                if m is None:
+                    end = len(routine)
+                    break
+                end = m.end()
+                nest += 1 if m.group() == '[' else -1
+            end = self.clip(c, end)
+            self.nest += routine.count('[', c, end) - routine.count(']', c, end)
+            if self.nest == 0:
+                self.state = None
+            return self.skip(c, end)
+
+        if self.state == 'STRING' or symbol == '"':  # Strings comment / STDOUT
+            start = c if self.state == 'STRING' else c + 1
+            self.state = 'STRING'
+            close = routine.find('"', start)
+            end = self.clip(c, len(routine) if close < 0 else close + 1)
+            if end > close >= 0:
+                self.state = None
+                self.str_out(routine[start:close] + '\n')
+            elif end > start:
+                self.str_out(routine[start:end])
+            return self.skip(c, end)
+
+        kind, end, arg = decode(routine, c)
+        if kind == 'skip':
+            return self.skip(c, self.clip(c, end))
+        elif kind == 'expr':
+            self.run_expression(arg)
+        elif kind == 'assign':
+            self.variables[arg[0]] = self.run_expression(arg[1])
+        elif kind == 'device':
+            self.buffer = arg
+        elif kind == 'output':
+            output = self.buffer if self.buffer is not None else self.EXP
+            if arg == '!':
+                self.bus = output
+            else:
+                self.output(output, WIDTHS[arg])
+                self.buffer = None
+        elif kind == 'print':
+            print(self.EXP, file=self.stdout)
+        elif kind == 'cond':
+            self.EXP = max_signed(self.EXP)
+            if self.EXP <= 0:
+                self.state = 'FCOND'
+                self.nest += 1
+        elif kind == 'repeat':
+            pointer.push(pointer.obj, self.EXP)
+        elif kind == 'end':
+            pointer.decr_repeat()
+        elif kind == 'macro':
+            if arg is None:
+                return self.call_macro(None)  # fails just like evaluate()
+            name, codes, length = arg
+            values = [self.run_expression(code) for code in codes]
+            pointer.advance(length)
+            macro = self.macros[name]
+            pointer.push(macro, 0, macro.call(values), values)
+            return macro
+        elif kind == 'return':
+            pointer.pop()
+            return pointer.advance()
+        elif kind == 'goto':
+            return pointer.goto(arg)
+        elif kind == 'paragraph':
+            self.paragraph = arg
+        return pointer.advance(end - c)
+
+    def skip(self, c, end):
+        """Advance over the symbols from c to end, counting each as a step."""
+        self.steps += end - c - 1
+        return self.pointer.advance(end - c)
+
+    def clip(self, c, end):
+        """Limit a run of symbols from c to end to the steps left before max_steps."""
+        if self.max_steps is not None:
+            return min(end, c + max(1, self.max_steps - self.steps))
+        return end
+
+    def run_expression(self, code):
+        """Evaluates an expression compiled by compile_expression(), exactly like expr_evaluate()."""
+        expression, parts = code
+        if parts is None:
+            return self.expr_evaluate(expression)
+        for kind, op, arg in parts:
+            if kind == 'const':
+                v = arg
+            elif kind == 'var':
+                v = self.variables.get(arg, 0)
+            elif kind == 'rand':
+                self.EXP = self.mrand(self.EXP)
+                continue
+            elif kind == 'read':
+                self.EXP = self.read_data()
+                continue
+            else:
+                v = self.get_val(arg)
+            self.EXP = v if op is None else op(self.EXP, v)
+        self.EXP = max_signed(self.EXP)
+        return self.EXP
 
-    def call_macro(self, routine):
-        m = RE_MACRO.match(routine)
+    def call_macro(self, m):
+        """Evaluate the actual parameters of a macro call, and start running the macro."""
         name, parameters = m.group(1, 2)
         values = [self.expr_evaluate(p) for p in parameters.split(',')]
-        self.pointer.advance(len(m.group(0)))
-        macro = copy(self.macros[name])
-        return macro.call(values)
+        self.pointer.advance(m.end() - m.start())
+        macro = self.macros[name]
+        routine = macro.call(values)
+        if DEBUG:
+            dprint(f'MACRO FOUND! {m.group()} => {routine}')
+        self.pointer.push(macro, 0, routine, values)
+        return macro
 
     def output(self, value, width):
         """Send an output to current bus."""
@@ -359,8 +711,11 @@ class Compiler():
             v = devices[value]
         else:
             v = value
-        v = oct(int(v))[-width//3:].replace('o', '0')
-        self.buses[self.bus - 1].send(v)
+        octal = OCTAL[width]
+        word = octal.get(v)
+        if word is None:
+            word = octal[v] = oct(int(v))[-width//3:].replace('o', '0')
+        self.buses[self.bus - 1].send(word)
 
     def write(self):
         """
@@ -369,37 +724,150 @@ class Compiler():
         #TODO: allow a range of data formats
         print(f'[Writing all data lists to {self.outfile}...]')
         with open(self.outfile, 'w') as f:
-            for b in self.buses:
-                f.write(' '.join(b.data))
-                f.write('\n')
+            f.write(self.lists())
+            f.write('\n')
+
+    def lists(self):
+        """Return all buses / lists in the text format read by sofkasim."""
+        return '\n'.join(' '.join(b.data) for b in self.buses)
+
+    def fingerprint(self):
+        """Digest of the parsed (and possibly optimised) program and its input."""
+        program = [self.main_program, sorted(self.lines.items()), sorted((n, m.body) for n, m in self.macros.items())]
+        return hashlib.sha256(json.dumps([program, self.paragraphs]).encode()).hexdigest()[:16]
+
+    def snapshot(self):
+        """Return the complete run state, as a dict that can be saved as JSON."""
+        return {
+            'version': SNAPSHOT_VERSION,
+            'program': self.fingerprint(),
+            'steps': self.steps,
+            'pointer': self.pointer.frames(),
+            'state': self.state,
+            'nest': self.nest,
+            'EXP': self.EXP,
+            'variables': self.variables,
+            'paragraph': self.paragraph,
+            'cursors': self.cursors,
+            'random': self.random.getstate(),
+            'bus': self.bus,
+            'buffer': self.buffer,
+            'buses': [[' '.join(b.data), b.buffer] for b in self.buses],
+        }
 
-    def run(self):
-        """ Run the program!"""
-        while self.evaluate():
-            pass
+    def restore(self, snapshot):
+        """Restore the run state from snapshot(), which must be of the same program and input."""
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            raise ValueError(f'Unsupported snapshot version {snapshot.get("version")!r}')
+        if snapshot['program'] != self.fingerprint():
+            raise ValueError('Snapshot is of a different program or input')
+        self.steps = snapshot['steps']
+        self.pointer = Pointer(self)
+        self.pointer.load(snapshot['pointer'], self)
+        self.state = snapshot['state']
+        self.nest = snapshot['nest']
+        self.EXP = snapshot['EXP']
+        self.variables = snapshot['variables']
+        self.paragraph = snapshot['paragraph']
+        self.cursors = snapshot['cursors']
+        version, internal, gauss = snapshot['random']
+        self.random.setstate((version, tuple(internal), gauss))
+        self.bus = snapshot['bus']
+        self.buffer = snapshot['buffer']
+        for bus, (data, buffer) in zip(self.buses, snapshot['buses']):
+            bus.data, bus.buffer = data.split(), buffer
+
+    def checkpoint(self, path):
+        """Save a compressed snapshot of the run state to path, replacing any earlier one."""
+        data = zlib.compress(json.dumps(self.snapshot(), separators=(',', ':')).encode())
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)  # never leave a partly written snapshot
+
+    def resume(self, path):
+        """Restore the run state saved to path by checkpoint()."""
+        with open(path, 'rb') as f:
+            self.restore(json.loads(zlib.decompress(f.read())))
+
+    def run(self, max_steps=None, checkpoint=None, every=CHECKPOINT_EVERY):
+        """
+        Run the program!
+        max_steps: optional limit on the number of symbols evaluated,
+        raises StepLimitExceeded if the program has not finished by then.
+        checkpoint: optional file to save a snapshot of the run state to, every `every` steps.
+        """
+        evaluate = getattr(self, ENGINES[self.engine])
+        self.max_steps = max_steps
+        next_checkpoint = self.steps + every
+        while evaluate():
+            self.steps += 1
+            if max_steps is not None and self.steps >= max_steps:
+                raise StepLimitExceeded(f'Program did not finish within {max_steps} steps.')
+            if checkpoint and self.steps >= next_checkpoint:
+                self.checkpoint(checkpoint)
+                next_checkpoint = self.steps + every
+
+
+def batch(source, inputs, max_steps=None, optimise=False, engine='reference', lockstep=True, seed=None):
+    """
+    Run one program over many datafile inputs.
+    The source is parsed (and optionally optimised) once, then each input is run
+    as a separate lane with its own variables, buses and STDOUT (captured in lane.stdout).
+    lockstep: run the lanes together, decoding each token once for every lane whose
+    control flow agrees (see lockstep.py), otherwise run them one after another.
+    seed: if not None, lane n seeds its random number generator with seed + n.
+    Returns the list of finished Compilers, one per input. A lane that fails does not
+    stop the others, its error is recorded as lane.error.
+    """
+    template = Compiler(source, engine=engine)
+    if optimise:
+        from optimiser import optimise as optimise_
+        optimise_(template)
+    lanes = [template.spawn(input_, StringIO(), None if seed is None else seed + n) for n, input_ in enumerate(inputs)]
+    if lockstep:
+        from lockstep import Lockstep
+        Lockstep(template, lanes, max_steps).run()
+        return lanes
+    for lane in lanes:
+        try:
+            lane.run(max_steps)
+        except Exception as e:
+            lane.error = describe(e)
+    return lanes
 
 
 class Macro():
+    __slots__ = ('name', 'body', 'expansions')
+
     def __init__(self, raw):
         data = [t.strip() for t in re.split('(^[A-Z]{2,6})', raw.strip()) if t]
         self.name, self.body = data
-        self.values = []
+        self.expansions = {}  # memo of body text for each tuple of actual parameters
         assert len(self.name) < 7
 
     def call(self, args):
-        result = self.body
-        for i, a in enumerate(args):
-            result = result.replace('%' + ALPHA[i], str(a))
-        dprint(f'Called {self.name} with {args}. RESULT = {result}')
-        self.values = args
-        self.routine = result
-        return self
+        """Return the macro body with formal parameters %A, %B, ... replaced by args."""
+        key = tuple(args)
+        result = self.expansions.get(key)
+        if result is None:
+            result = self.body
+            for i, a in enumerate(args):
+                result = result.replace('%' + ALPHA[i], str(a))
+            dprint(f'Called {self.name} with {args}. RESULT = {result}')
+            if len(self.expansions) >= CACHE_SIZE:
+                self.expansions.clear()
+            self.expansions[key] = result
+        return result
 
     def __repr__(self):
         return f'Macro <{self.name}>: {self.body}'
 
 
 class Bus():
+    __slots__ = ('n', 'data', 'buffer')
+
     def __init__(self, n):
         self.n = n
         self.data = []  # a list of octal numbers
@@ -408,7 +876,13 @@ class Bus():
     def send(self, n):
         """n is 2 or 4 digit octal string"""
         if self.buffer:
-            self.data.append(self.buffer + n)
+            words = WORDS.get(self.buffer)
+            if words is None:
+                words = WORDS[self.buffer] = {}
+            word = words.get(n)
+            if word is None:
+                word = words[n] = self.buffer + n
+            self.data.append(word)
             self.buffer = ''
         elif len(n) == 2:
             self.buffer = n
@@ -420,22 +894,61 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="MUSYS (1973) simulator.")
     parser.add_argument('file', help='MUSYS source file to process')
     parser.add_argument('-d', '--debug', help='turn on debug output', action='store_true')
-    parser.add_argument('-i', '--input', help='input file; paragraphs (A-Z) of numerical data')
+    parser.add_argument('-e', '--engine', help='evaluation engine (default: reference)',
+                        choices=ENGINES, default='reference')
+    parser.add_argument('-O', '--optimise', help='optimise the program before running it: '
+                        'inline small macros, fold constants and remove unreachable code', action='store_true')
+    parser.add_argument('-i', '--input', help='input file; paragraphs (A-Z) of numerical data. '
+                        'Repeat to run the program once per input file (batch mode)', action='append')
+    parser.add_argument('-s', '--seed', help='seed for the random number generator; '
+                        'in batch mode lane n is seeded with SEED + n', type=int)
+    parser.add_argument('--checkpoint', help='save snapshots of the run state to this file', metavar='FILE')
+    parser.add_argument('--checkpoint-every', help=f'steps between snapshots (default: {CHECKPOINT_EVERY})',
+                        type=int, default=CHECKPOINT_EVERY, metavar='N')
+    parser.add_argument('--resume', help='resume the run from the snapshot in this file, if it exists', metavar='FILE')
+    parser.add_argument('--max-steps', help='limit on the steps each run takes', type=int, metavar='N')
     args = parser.parse_args()
 
     DEBUG = args.debug
     source = args.file
-    input_ = args.input
-
-    if input_:
+    inputs = []
+    for input_ in args.input or []:
         with open(input_) as data:
-            input_ = data.read()
+            inputs.append(data.read())
 
     with open(source, 'r') as f:
-        musys = Compiler(f.read(), input_)
-
+        source = f.read()
+
+    if len(inputs) > 1:
+        if args.checkpoint or args.resume:
+            parser.error('--checkpoint and --resume cannot be used in batch mode')
+        import musysim  # so lockstep.py and the lanes share the classes of one module, not __main__
+        musysim.DEBUG = args.debug
+        lanes = musysim.batch(source, inputs, args.max_steps, args.optimise, args.engine, seed=args.seed)
+        for n, (lane, input_) in enumerate(zip(lanes, args.input)):
+            print(f'== LANE {n + 1}: {input_} ==')
+            print(lane.stdout.getvalue(), end='')
+            for i, bus in enumerate(lane.buses):
+                if bus.data:
+                    print(f'BUS{i+1}: {bus.data}')
+            if lane.error:
+                print(f'[Error: {lane.error}]')
+            lane.outfile = f'musys-{n + 1}.out'
+            lane.write()
+        raise SystemExit
+
+    musys = Compiler(source, inputs[0] if inputs else None, engine=args.engine, seed=args.seed)
+    if args.optimise:
+        from optimiser import optimise
+        for change in optimise(musys):
+            print(f'[Optimised {change}]')
     dprint(musys)
-    musys.run()
+    if args.resume and os.path.exists(args.resume):
+        musys.resume(args.resume)
+        print(f'[Resuming from {args.resume} at step {musys.steps}...]')
+    elif args.resume:
+        print(f'[No snapshot in {args.resume}, starting from the beginning...]')
+    musys.run(args.max_steps, args.checkpoint, args.checkpoint_every)
     for i, bus in enumerate(musys.buses):
         if bus.data:
             print(f'BUS{i+1}: {bus.data}')
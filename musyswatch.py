@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Watch mode and interactive REPL for MUSYSim.
+
+Both keep a live Compiler and Sofka performance of the program being
+edited. On each change only the lines and macros whose source changed
+are parsed again, the program is re-run, and the performance is
+re-rendered from the first bus word that differs from the last run.
+
+Watch a source file, rewriting the Nyquist code on every save:
+
+    ./musyswatch.py score.musys -i data.txt -o score.ny
+
+Or edit a program interactively:
+
+    ./musyswatch.py --repl [score.musys]
+
+In the REPL, enter `N routine` to add or replace line number N, `N` to
+delete it, `NAME routine @` to define or replace a macro, or any other
+routine to run it once with the current macros. :help lists commands.
+"""
+
+import argparse
+import os
+import re
+import time
+from io import StringIO
+
+from musysim import ENGINES, Compiler
+from sofkasim import PRELUDE, Performance
+
+
+MAX_STEPS = 10000000  # limit on the steps each run of the program takes
+POLL = 0.1  # seconds between checks for a changed file
+
+RE_LINE = re.compile(r'([0-9]+)(?:\s(.*))?$')
+RE_MACRO_DEF = re.compile(r'([A-Z]{2,6})\s.*@$')
+
+HELP = """N routine       add or replace line number N
+N               delete line number N
+NAME routine @  define or replace macro NAME
+routine         run routine once, with the current macros
+:list           show the program
+:load FILE      load the program from FILE
+:save FILE      save the program to FILE
+:input FILE     read datafile input from FILE
+:write [FILE]   write the data lists to musys.out, and Nyquist code to FILE
+:quit           leave the REPL"""
+
+
+def split_source(source):
+    """Split source into its list of main program lines and list of macro definitions."""
+    main_program, macros = re.split(r'\$', source.strip())
+    lines = [line for line in main_program.split('\n') if line]
+    return lines, [m.strip() for m in re.split(r'\s*@\s+|@$', macros) if m.strip()]
+
+
+def join_source(lines, macros):
+    return '\n'.join(lines) + '\n$\n' + ''.join(f'{m} @\n' for m in macros)
+
+
+def edit(source, entry):
+    """
+    Return source changed by a REPL entry: 'N routine' adds or replaces line
+    number N, 'N' deletes it, and 'NAME routine @' defines or replaces a macro.
+    None if entry is not an edit.
+    """
+    lines, macros = split_source(source)
+    m = RE_LINE.match(entry)
+    if m:
+        number = int(m.group(1))
+        numbers = [RE_LINE.match(line) for line in lines]
+        numbers = [int(n.group(1)) if n and n.group(2) is not None else None for n in numbers]
+        if number in numbers:
+            i = numbers.index(number)
+            del lines[i]
+        else:  # before the first line with a larger number
+            i = next((i for i, n in enumerate(numbers) if n is not None and n > number), len(lines))
+        if m.group(2) is not None:
+            lines.insert(i, entry)
+        return join_source(lines, macros)
+    m = RE_MACRO_DEF.match(entry)
+    if m:
+        name = m.group(1)
+        entry = entry[:-1].strip()
+        names = [re.match(r'[A-Z]*', d).group() for d in macros]
+        if name in names:
+            macros[names.index(name)] = entry
+        else:
+            macros.append(entry)
+        return join_source(lines, macros)
+    return None
+
+
+class Session:
+    """A live Compiler and Sofka performance of a program that is being edited."""
+
+    def __init__(self, source='$', input_=None, engine='fast', seed=0, max_steps=MAX_STEPS):
+        self.source = source
+        self.input = input_
+        self.seed = seed  # the same random numbers each run, so only edits change the output
+        self.max_steps = max_steps
+        self.musys = Compiler(source, input_, StringIO(), engine, seed)
+        self.performance = Performance()
+        self.output = None  # Nyquist code for the last successful run
+        self.error = None
+        self.run()
+
+    def update(self, source=None, input_=None):
+        """
+        Recompile the parts of source that changed, re-run the program and re-render the performance.
+        Returns a one line report of what changed, and how long it took.
+        """
+        t = time.perf_counter()
+        changes = []
+        if input_ is not None:
+            self.input = input_
+            changes.append('input')
+        if source is not None:
+            try:
+                changes += self.musys.reload(source)
+            except Exception as e:
+                self.error = f'{type(e).__name__}: {e}'
+                return f'Not recompiled, {self.error}'
+            self.source = source
+        self.run()
+        t = time.perf_counter() - t
+        report = f'Recompiled {", ".join(changes) or "nothing"} in {t:.3f}s, '
+        if self.error:
+            return report + self.error
+        return report + f'replayed {self.performance.replayed} of {len(self.performance.words)} words'
+
+    def run(self):
+        """Run the program from the start, and render its performance."""
+        self.musys.reset(self.input, StringIO(), self.seed)
+        self.error = None
+        try:
+            self.musys.run(self.max_steps)
+            self.output = f'{PRELUDE}(play {self.performance.render(self.musys.lists())})'
+        except Exception as e:
+            self.error = f'{type(e).__name__}: {e}'
+
+    def immediate(self, routine):
+        """Run routine once with the current macros, returning the finished Compiler."""
+        musys = self.musys.spawn(self.input, StringIO(), self.seed)
+        musys.main_program, musys.lines = [routine], {}
+        musys.run(self.max_steps)
+        return musys
+
+    def write(self, nyquist=None):
+        """Write the data lists to the Compiler's outfile, and the Nyquist code to nyquist."""
+        self.musys.write()
+        if nyquist and self.output:
+            with open(nyquist, 'w') as f:
+                f.write(self.output + '\n')
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def watch(session, path, input_path=None, nyquist=None, poll=POLL):
+    """Update the session each time the source or input file is saved, until interrupted."""
+    def mtimes():
+        return [os.stat(p).st_mtime_ns if os.path.exists(p) else None for p in (path, input_path) if p]
+
+    last = mtimes()
+    session.write(nyquist)
+    print(f'[Watching {path}, {session.error or "ready"}]')
+    while True:
+        time.sleep(poll)
+        now = mtimes()
+        if now == last:
+            continue
+        last = now
+        try:  # some editors save by removing and replacing the file
+            source, input_ = read(path), read(input_path) if input_path else None
+        except OSError as e:
+            print(f'[{e}]')
+            continue
+        print(session.update(source, input_))
+        print(session.musys.stdout.getvalue(), end='')
+        session.write(nyquist)
+
+
+def repl(session, nyquist=None):
+    """Read and apply edits and commands until :quit or end of input."""
+    print('MUSYS REPL, :help for help')
+    while True:
+        try:
+            entry = input('> ').strip()
+        except EOFError:
+            break
+        command, _, arg = entry.partition(' ')
+        arg = arg.strip()
+        try:
+            if not entry:
+                continue
+            elif command in (':quit', ':q'):
+                break
+            elif command == ':help':
+                print(HELP)
+            elif command == ':list':
+                print(session.source.strip())
+            elif command == ':load':
+                print(session.update(read(arg)))
+            elif command == ':save':
+                with open(arg, 'w') as f:
+                    f.write(session.source)
+            elif command == ':input':
+                print(session.update(input_=read(arg)))
+            elif command == ':write':
+                session.write(arg or nyquist)
+            elif command.startswith(':'):
+                print(f'Unknown command {command}, :help for help')
+            else:
+                source = edit(session.source, entry)
+                if source is not None:
+                    print(session.update(source))
+                    print(session.musys.stdout.getvalue(), end='')
+                    continue
+                musys = session.immediate(entry)
+                print(musys.stdout.getvalue(), end='')
+                print(f'EXP: {musys.EXP}')
+                for i, bus in enumerate(musys.buses):
+                    if bus.data:
+                        print(f'BUS{i+1}: {bus.data}')
+        except Exception as e:
+            print(f'{type(e).__name__}: {e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="MUSYS (1973) simulator watch mode and REPL.")
+    parser.add_argument('file', help='MUSYS source file to watch, or to load into the REPL', nargs='?')
+    parser.add_argument('-r', '--repl', help='edit the program interactively', action='store_true')
+    parser.add_argument('-i', '--input', help='input file; paragraphs (A-Z) of numerical data')
+    parser.add_argument('-o', '--output', help='file to write the Nyquist code to (default: musys.ny)', default='musys.ny')
+    parser.add_argument('-e', '--engine', help='evaluation engine (default: fast)', choices=ENGINES, default='fast')
+    parser.add_argument('-s', '--seed', help='seed for the random number generator', type=int, default=0)
+    parser.add_argument('--max-steps', help='limit on the steps each run takes', type=int, default=MAX_STEPS)
+    args = parser.parse_args()
+    if not (args.file or args.repl):
+        parser.error('a file to watch is required, unless using --repl')
+
+    source = read(args.file) if args.file else '$'
+    session = Session(source, read(args.input) if args.input else None, args.engine, args.seed, args.max_steps)
+    try:
+        if args.repl:
+            repl(session, args.output)
+        else:
+            watch(session, args.file, args.input, args.output)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,259 @@
+"""
+Static optimiser for MUSYSim.
+
+Rewrites the main program and macros of a parsed Compiler before it is run:
+
+1. Inlines calls to small, non-recursive macros with constant arguments.
+2. Folds constant expressions, using the strict left to right
+   evaluation of MUSYS (Grogono, 1973. p.373).
+3. Removes code that can never run after an unconditional
+   G (goto) or @ (early return from macro).
+
+Each rewrite leaves the program's output unchanged.
+"""
+
+import re
+
+from musysim import OPERATORS, max_signed, next_token
+
+
+INLINE_SIZE = 80  # largest macro body (in characters) that will be inlined
+
+RE_CONST_EXPR = re.compile(r'[0-9]+(?:[-+&<>/*][0-9]+)+')
+RE_CONST_PARAM = re.compile(r'\s*([0-9]+(?:[-+&<>/*][0-9]+)*)\s*')
+RE_SPACE = re.compile(r'\s*')
+EXPRESSION_CHARS = set('0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ+-*/&<>')
+
+
+def const_value(expr):
+    """
+    Evaluate a constant expression strictly left to right,
+    without wrapping to 12 bits. None if it divides by zero.
+    """
+    parts = re.split(r'([-+&<>/*])', expr)
+    v = int(parts[0])
+    for op, x in zip(parts[1::2], parts[2::2]):
+        if op == '/' and int(x) == 0:
+            return None
+        v = OPERATORS[op](v, int(x))
+    return v
+
+
+def scan(routine, in_string=False):
+    """
+    Yield (kind, start, end, match) for each token in routine.
+    Strings are yielded whole as 'string', or as 'open' if they are
+    not closed before the end of the routine. in_string is True if
+    routine starts inside a string left open by the previous line.
+    """
+    c = 0
+    while c < len(routine):
+        if in_string or routine[c] == '"':
+            end = routine.find('"', c if in_string else c + 1)
+            if end < 0:
+                yield 'open', c, len(routine), None
+                return
+            yield 'string', c, end + 1, None
+            in_string = False
+            c = end + 1
+            continue
+        kind, end, m = next_token(routine, c)
+        yield kind, c, end, m
+        c = end
+
+
+def call_ends(routine, in_string=False):
+    """
+    Return the set of positions just after each macro call in routine.
+    A macro that returns with @ resumes there but then skips a character
+    (see Compiler.evaluate), so a token starting there must be left as it is.
+    """
+    return {end for kind, _, end, _ in scan(routine, in_string) if kind == 'macro'}
+
+
+def balanced(routine):
+    """True if all brackets in routine are properly nested and all strings are closed."""
+    for o, c in ('[]', '()'):
+        depth = 0
+        for ch in routine:
+            depth += (ch == o) - (ch == c)
+            if depth < 0:
+                return False
+        if depth:
+            return False
+    return routine.count('"') % 2 == 0
+
+
+def const_params(params):
+    """Return the values of a macro call's parameters if all are constant, else None."""
+    values = []
+    for p in params.split(','):
+        m = RE_CONST_PARAM.fullmatch(p)
+        v = m and const_value(m.group(1))
+        if v is None:
+            return None
+        values.append(max_signed(v))
+    return values
+
+
+def expand(macro, values, size):
+    """
+    Return the text that can replace a call to macro with values,
+    or None if the macro is not small and simple enough to inline.
+    """
+    if len(macro.body) > size:
+        return None
+    body = macro.call(values)
+    # A repeat count of 0 restarts the routine, which is the main program once inlined
+    if re.search(r'[%#@(]|G[0-9]', body) or not balanced(body):
+        return None
+    # The call leaves EXP set to the last argument, unless the body sets it first.
+    start = RE_SPACE.match(body).end()
+    if start < len(body) and body[start] != '"' and next_token(body, start)[0] in ('expr', 'assign'):
+        return f' {body} '
+    last = values[-1]
+    return f' {last if last >= 0 else f"0-{-last}"} {body} '
+
+
+def inline_macros(routine, in_string, after_call, macros, size, where, report):
+    """
+    Replace calls to small macros with constant arguments by the macro body.
+    after_call: routine is a line following a line that ends with a macro call.
+    """
+    out, last = [], 0
+    skipped = call_ends(routine, in_string) | ({0} if after_call else set())
+    for kind, start, end, m in scan(routine, in_string):
+        in_string = kind == 'open'
+        if kind != 'macro' or m is None or m.group(1) not in macros or start in skipped:
+            continue
+        values = const_params(m.group(2))
+        text = values and expand(macros[m.group(1)], values, size)
+        if text:
+            out += [routine[last:start], text]
+            last = end
+            report.append(f'{where}: inlined {m.group(0)!r}')
+    return ''.join(out) + routine[last:], in_string
+
+
+def after_parameter(routine, s):
+    """
+    True if routine[s] continues a run of expression characters that starts with
+    a formal parameter, e.g. the 2 of %A1+2*3, which is not an expression of its own
+    once the macro is called and %A replaced by digits.
+    """
+    b = s
+    while b > 0 and routine[b - 1] in EXPRESSION_CHARS:
+        b -= 1
+    return routine[b - 1:b] == '%'
+
+
+def fold_constants(routine, in_string, after_call, where, report):
+    """
+    Fold the constant leading part of each expression to a single number.
+    after_call: routine is a line following a line that ends with a macro call.
+    """
+    out, last = [], 0
+    skipped = call_ends(routine, in_string) | ({0} if after_call else set())
+    for kind, start, end, m in scan(routine, in_string):
+        in_string = kind == 'open'
+        if kind not in ('expr', 'assign') or start in skipped:
+            continue
+        s = m.start(2) if kind == 'assign' else start
+        const = RE_CONST_EXPR.match(routine, s)
+        # A following %A could be replaced by digits, and join on to the constant
+        if not const or routine[const.end():const.end() + 1] == '%' or after_parameter(routine, s):
+            continue
+        v = const_value(const.group())
+        if v is None or v < 0:
+            continue
+        out += [routine[last:s], str(v)]
+        last = const.end()
+        report.append(f'{where}: folded {const.group()!r} to {str(v)!r}')
+    return ''.join(out) + routine[last:], in_string
+
+
+def unreachable(routine, in_string, depth, terminators):
+    """
+    Return (position, in_string, depth) where position is the end of the first
+    terminator that is always taken when reached, or None if there is none.
+    depth is the [] nesting of all characters before the routine, as counted when
+    skipping a false condition, or None once it has gone negative.
+    """
+    repeats = 0
+    c = 0
+    for kind, start, end, m in scan(routine, in_string):
+        if depth is not None:
+            for ch in routine[c:start]:
+                depth += (ch == '[') - (ch == ']')
+                if depth < 0:
+                    depth = None
+                    break
+        c = start
+        in_string = kind == 'open'
+        if kind in ('string', 'open') and re.search(r'[][]', routine[start:end]):
+            depth = None  # a false condition ends at a ] even in a string, so it is not known where
+        repeats += (kind == 'repeat') - (kind == 'end')
+        if kind in terminators and depth == 0 and (kind == 'goto' or repeats == 0):
+            return end, False, depth
+    if depth is not None:
+        for ch in routine[c:]:
+            depth += (ch == '[') - (ch == ']')
+            if depth < 0:
+                return None, in_string, None
+    return None, in_string, depth
+
+
+def remove_dead_code(musys, report):
+    """Remove code after unconditional gotos in the main program, and returns in macros."""
+    numbered = {i: n for n, i in musys.lines.items()}
+    program, lines = [], {}
+    in_string, depth, dead = False, 0, False
+    for i, line in enumerate(musys.main_program):
+        if dead and i not in numbered:
+            report.append(f'line {i + 1}: removed unreachable {line!r}')
+            continue
+        if i in numbered:
+            lines[numbered[i]] = len(program)
+        end, in_string, depth = unreachable(line, in_string, depth, ('goto',))
+        dead = end is not None
+        if dead and line[end:].strip():
+            report.append(f'line {i + 1}: removed unreachable {line[end:]!r}')
+            line = line[:end]
+        program.append(line)
+    musys.main_program, musys.lines = program, lines
+
+    for name, macro in musys.macros.items():
+        end, _, _ = unreachable(macro.body, False, 0, ('return',))
+        if end is not None and macro.body[end:].strip():
+            report.append(f'macro {name}: removed unreachable {macro.body[end:]!r}')
+            macro.body = macro.body[:end]
+            macro.expansions.clear()
+
+
+def optimise(musys, size=INLINE_SIZE):
+    """
+    Optimise a parsed Compiler in place, before it is run.
+    size: largest macro body to inline, 0 to disable inlining.
+    Returns a list of descriptions of each change made.
+    """
+    report = []
+    units = [(f'line {i + 1}', i, None) for i in range(len(musys.main_program))]
+    units += [(f'macro {name}', None, macro) for name, macro in musys.macros.items()]
+    in_string, after_call = False, False
+    for where, i, macro in units:
+        if macro is None:
+            routine = musys.main_program[i]
+        else:
+            routine, in_string, after_call = macro.body, False, False
+        start = in_string
+        new, _ = inline_macros(routine, start, after_call, musys.macros, size, where, report)
+        new, in_string = fold_constants(new, start, after_call, where, report)
+        after_call = len(new) in call_ends(new, start)
+        if macro is None:
+            musys.main_program[i] = new
+        else:
+            macro.body = new
+            macro.expansions.clear()
+    remove_dead_code(musys, report)
+    musys.parsed_macros.clear()  # the macros no longer match their source, so never reuse them
+    return report
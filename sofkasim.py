@@ -17,6 +17,7 @@ Nyquist code.
 
 DEBUG = False
 MAX_INTERRUPT_FREQ = 16000
+CHECKPOINT_WORDS = 256  # words played between saved states of a Performance
 PRELUDE = f"(set-control-srate {MAX_INTERRUPT_FREQ})"
 
 
@@ -38,6 +39,7 @@ class Sofka:
         self.oscillators = [None] * 3
         self.envelopes = [None] * 3
         self.current_time = 0
+        self.active = None  # index of the last oscillator changed
 
     def perform(self):
         # TODO this needs to be refactored once a sensible system
@@ -47,36 +49,43 @@ class Sofka:
             if not b[0]:
                 continue
             for c in b:
-                n = int(c[:2], 8)
-                v = int(c[2:], 8)
-                device = get_device(int(c[:2], 8))
-                dprint(device, c)
-                if n == 62:  # Interrupt timer
-                    self.clock = v
-                if 0 < n < 4:  # Osc
-                    dprint('OSC', n)
-                    if self.oscillators[n - 1]:
-                        self.oscillators[n - 1].change(v)
-                    else:
-                        self.oscillators[n - 1] = Oscillator(v)
-                    self.active = n - 1
-                if 23 < n < 27:  # Envelopes
-                    n = n - 24
-                    dprint('Envelope', n + 1)
-                    t = self.current_time
-                    d = self.secs(v)
-                    if self.envelopes[n]:
-                        self.envelopes[n].addstage(t, d)
-                    else:
-                        self.envelopes[n] = Envelope(t, d)
-                    self.current_time += d
-                    self.oscillators[self.active].addtime(d)
-                if n == 60:  # Wait timer
-                    d = self.secs(v)
-                    dprint('WAIT:', d)
-                    self.current_time += d
-                    self.oscillators[self.active].addtime(d)
-        # Write the generated audio
+                self.play(c)
+        return self.out()
+
+    def play(self, c):
+        """Perform one data word c (4 digit octal string)."""
+        n = int(c[:2], 8)
+        v = int(c[2:], 8)
+        device = get_device(int(c[:2], 8))
+        dprint(device, c)
+        if n == 62:  # Interrupt timer
+            self.clock = v
+        if 0 < n < 4:  # Osc
+            dprint('OSC', n)
+            if self.oscillators[n - 1]:
+                self.oscillators[n - 1].change(v)
+            else:
+                self.oscillators[n - 1] = Oscillator(v)
+            self.active = n - 1
+        if 23 < n < 27:  # Envelopes
+            n = n - 24
+            dprint('Envelope', n + 1)
+            t = self.current_time
+            d = self.secs(v)
+            if self.envelopes[n]:
+                self.envelopes[n].addstage(t, d)
+            else:
+                self.envelopes[n] = Envelope(t, d)
+            self.current_time += d
+            self.oscillators[self.active].addtime(d)
+        if n == 60:  # Wait timer
+            d = self.secs(v)
+            dprint('WAIT:', d)
+            self.current_time += d
+            self.oscillators[self.active].addtime(d)
+
+    def out(self):
+        """Nyquist code for the words performed so far."""
         sources = [o for o in self.oscillators if o]
         sources += [e for e in self.envelopes if e]
         dprint('SOURCES', sources)
@@ -87,6 +96,71 @@ class Sofka:
         """ Number of seconds of time with current clock."""
         return n * 1 / self.clock
 
+    def state(self):
+        """
+        Save the state of the performance so far, for restore().
+        Oscillator histories and envelope stages are only ever appended to,
+        so only their lengths are kept.
+        """
+        oscillators = [o and (o, o.pitch, o.duration, o.phase, len(o.history)) for o in self.oscillators]
+        envelopes = [e and (e, len(e.stages)) for e in self.envelopes]
+        return self.clock, self.current_time, self.active, oscillators, envelopes
+
+    def restore(self, state):
+        """Return the performance to a state() saved earlier."""
+        self.clock, self.current_time, self.active, oscillators, envelopes = state
+        self.oscillators = [o and o[0] for o in oscillators]
+        self.envelopes = [e and e[0] for e in envelopes]
+        for o, pitch, duration, phase, n in filter(None, oscillators):
+            o.pitch, o.duration, o.phase = pitch, duration, phase
+            del o.history[n:]
+        for e, n in filter(None, envelopes):
+            del e.stages[n:]
+
+
+class Performance:
+    """
+    A Sofka performance that can be re-rendered for new lists,
+    replaying only from the first word that differs from the last lists rendered.
+    """
+    def __init__(self, every=CHECKPOINT_WORDS):
+        self.sofka = Sofka('')
+        self.every = every
+        self.words = []  # all words of the last lists rendered, in the order performed
+        self.states = [self.sofka.state()]  # state before each `every` words
+        self.replayed = 0  # number of words played by the last render()
+
+    def render(self, lists):
+        """Return the Nyquist code performing lists, as Sofka(lists).perform() would."""
+        words = [c for b in Sofka(lists).lists if b[0] for c in b]
+        if words == self.words:
+            self.replayed = 0
+            return self.sofka.out()
+        same = 0
+        for same, (old, new) in enumerate(zip(self.words, words)):
+            if old != new:
+                break
+        else:
+            same = min(len(self.words), len(words))
+        k = min(same // self.every, len(self.states) - 1)  # the state after the last words is not saved
+        self.sofka.restore(self.states[k])
+        del self.states[k + 1:]
+        self.words = words[:k * self.every]
+        try:
+            for i in range(k * self.every, len(words)):
+                if i % self.every == 0 and i // self.every == len(self.states):
+                    self.states.append(self.sofka.state())
+                self.sofka.play(words[i])
+                self.words.append(words[i])
+        except Exception:
+            # the failing word may have been partly played, go back to the last saved state
+            self.sofka.restore(self.states[-1])
+            del self.words[(len(self.states) - 1) * self.every:]
+            raise
+        finally:
+            self.replayed = max(0, len(self.words) - k * self.every)
+        return self.sofka.out()
+
 
 class Envelope:
     def __init__(self, current_time, duration):
@@ -131,16 +205,16 @@ class Oscillator:
         self.duration += d
 
     def change(self, pitch):
-        self.history.append(
-            f"(osc {self.pitch} {round(self.duration, 3)} *table* {round(self.phase, 3)})"
-        )
+        self.history.append(self.current())
         self.phase = (self.phase + self.duration * freq(self.pitch)) % 360
         self.pitch = pitch + 28
         self.duration = 0
 
+    def current(self):
+        return f"(osc {self.pitch} {round(self.duration, 3)} *table* {round(self.phase, 3)})"
+
     def out(self):
-        self.change(0)
-        return self.history
+        return self.history + [self.current()]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,33 @@
+import io
+
+import pytest
+from conformance import compare, example_programs, paper_programs, random_programs
+from musysim import Compiler, StepLimitExceeded
+
+
+@pytest.mark.parametrize('name, source, input_', [
+    *example_programs(),
+    *paper_programs(),
+    *random_programs(50),
+])
+def test_engines_agree(name, source, input_):
+    differences, _, _ = compare(source, input_, max_steps=20000)
+    assert differences == []
+
+
+def test_fast_engine_stops_at_same_step():
+    """Runs of symbols evaluated in one step by the fast engine still count each symbol."""
+    code = '"TRUTH MACHINE"\n1 1"1"\n1[G1]\n$'
+    stopped = []
+    for engine in ('reference', 'fast'):
+        m = Compiler(code, stdout=io.StringIO(), engine=engine)
+        with pytest.raises(StepLimitExceeded):
+            m.run(1001)
+        stopped.append((m.steps, m.pointer.l, m.pointer.c, m.stdout.getvalue()))
+    assert stopped[0] == stopped[1]
+    assert stopped[0][0] == 1001
+
+
+def test_unknown_engine():
+    with pytest.raises(ValueError):
+        Compiler('1 $', engine='turbo')
@@ -0,0 +1,62 @@
+import io
+import random
+
+import pytest
+from conformance import RandomProgram, example_programs, final_state, paper_programs, random_programs
+from lockstep import Lockstep
+from musysim import Compiler, batch
+
+
+INPUTS = [RandomProgram(1000 + n).input() for n in range(4)] + ['1 2 3\n\n4\n\n5 6', '', '0 0 0 0 0 0 0 0 0 1']
+
+
+def lanes_state(lanes):
+    return [final_state(lane, lane.error) for lane in lanes]
+
+
+def run_both(source, inputs, max_steps=20000):
+    """Run a batch in lockstep and one lane after another, with the same random numbers."""
+    random.seed(2)
+    sequential = batch(source, inputs, max_steps, engine='fast', lockstep=False)
+    random.seed(2)
+    lockstep = batch(source, inputs, max_steps, engine='fast')
+    return lanes_state(sequential), lanes_state(lockstep)
+
+
+@pytest.mark.parametrize('name, source, input_', [
+    *example_programs(),
+    *paper_programs(),
+    *random_programs(40),
+])
+def test_lockstep_agrees(name, source, input_):
+    sequential, lockstep = run_both(source, [input_] + INPUTS)
+    assert lockstep == sequential
+
+
+@pytest.mark.parametrize('name, source, input_', list(random_programs(20, seed=100)))
+def test_lockstep_agrees_at_step_limit(name, source, input_):
+    sequential, lockstep = run_both(source, [input_] + INPUTS, max_steps=150)
+    assert lockstep == sequential
+
+
+def test_failing_lane_does_not_stop_batch():
+    lanes = batch(r'←A ←\ ←\ $', ['1 2', '3', '4 5'])
+    assert [lane.stdout.getvalue() for lane in lanes] == ['1\n2\n', '3\n', '4\n5\n']
+    assert [lane.error for lane in lanes] == [None, 'IndexError: no more data in paragraph A', None]
+    lanes = batch('←A ←[G1] G2\n1 1[G1]\n2 0\n$', ['0', '1'], max_steps=100)
+    assert lanes[0].error is None
+    assert lanes[1].error == 'Program did not finish within 100 steps.'
+    assert batch(r'←A X=← 10/X $', ['0', '2'])[0].error == 'ZeroDivisionError: integer division or modulo by zero'
+
+
+def test_lanes_fall_back_to_own_engine():
+    """Lanes left on their own fall back to running with their own Compiler, with the same results."""
+    _, source, input_ = next(random_programs(1, seed=7))
+    inputs = [input_] * 3 + INPUTS
+    random.seed(3)
+    expected = lanes_state(batch(source, inputs, 20000, engine='fast', lockstep=False))
+    random.seed(3)
+    template = Compiler(source, engine='fast')
+    lanes = [template.spawn(i, io.StringIO()) for i in inputs]
+    Lockstep(template, lanes, 20000, fallback_steps=0).run()
+    assert lanes_state(lanes) == expected
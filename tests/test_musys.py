@@ -1,5 +1,9 @@
+import io
+import json
+import tracemalloc
+
 import pytest
-from musysim import Compiler, max_signed
+from musysim import Compiler, StepLimitExceeded, batch, max_signed
 
 
 def test_register_addition():
@@ -64,6 +68,14 @@ def test_factorial_recursive_macro():
     assert m.EXP == 24
 
 
+@pytest.mark.parametrize('engine', ['reference', 'fast'])
+def test_macro_continues_after_repeat(engine):
+    """Ending a repeat inside a macro resumes the macro rather than returning from it."""
+    m = Compiler(r"#MM 1; \ $ MM 3(X=X+1) X\ @", stdout=io.StringIO(), engine=engine)
+    m.run()
+    assert m.stdout.getvalue() == '3\n3\n'
+
+
 def test_12bit_output():
     """
     12bit variable oscillator output test example from
@@ -73,3 +85,96 @@ def test_12bit_output():
     m = Compiler(code)
     m.run()
     assert m.buses[0].data == ['0010', '1750']
+
+
+def test_spawn_has_separate_state():
+    m = Compiler("X=X+1 $")
+    lane = m.spawn()
+    lane.run()
+    assert lane.variables == {'X': 1}
+    assert m.variables == {}
+    assert lane.main_program is m.main_program
+
+
+def test_batch_one_program_many_inputs():
+    code = r"←A ←\ 2(←.) $"
+    lanes = batch(code, ['1 2 3', '4 5 6\n\n7'])
+    assert [lane.stdout.getvalue() for lane in lanes] == ['1\n', '4\n']
+    assert [lane.buses[0].data for lane in lanes] == [['0203'], ['0506']]
+    lanes = batch(code, ['1 2 3', '4 5 6\n\n7'], lockstep=False)
+    assert [lane.buses[0].data for lane in lanes] == [['0203'], ['0506']]
+    assert [lane.error for lane in lanes] == [None, None]
+
+
+@pytest.mark.parametrize('lockstep', [True, False])
+def test_batch_seed(lockstep):
+    code = r"5(1000↑\) $"
+    lanes = batch(code, ['', ''], seed=7, lockstep=lockstep)
+    for n, lane in enumerate(lanes):
+        m = Compiler(code, stdout=io.StringIO(), seed=7 + n)
+        m.run()
+        assert lane.stdout.getvalue() == m.stdout.getvalue()
+    assert lanes[0].stdout.getvalue() != lanes[1].stdout.getvalue()
+
+
+CHECKPOINT_CODE = """←A X=0 5(X=X+1 #NOTE ←, X↑; X[1"HI"] 0["NO"])
+$
+NOTE O1.%A. A1.%B. 3(Y=Y+%A) @"""
+
+
+def run_all(m):
+    m.run()
+    return m.stdout.getvalue(), m.EXP, m.variables, [(b.data, b.buffer) for b in m.buses], m.steps
+
+
+@pytest.mark.parametrize('engine', ['reference', 'fast'])
+def test_snapshot_resume_anywhere(engine):
+    """Stopping at any step and resuming from a snapshot gives the same run as not stopping."""
+    expected = run_all(Compiler(CHECKPOINT_CODE, '1 2 3 4 5 6', io.StringIO(), engine, seed=7))
+    for k in range(1, expected[-1], 7):
+        first = Compiler(CHECKPOINT_CODE, '1 2 3 4 5 6', io.StringIO(), engine, seed=7)
+        with pytest.raises(StepLimitExceeded):
+            first.run(k)
+        snapshot = json.loads(json.dumps(first.snapshot()))
+        second = Compiler(CHECKPOINT_CODE, '1 2 3 4 5 6', io.StringIO(), engine)
+        second.restore(snapshot)
+        stdout, *state = run_all(second)
+        assert [first.stdout.getvalue() + stdout, *state] == list(expected)
+
+
+def test_checkpoint_file(tmp_path):
+    path = str(tmp_path / 'run.ckpt')
+    m = Compiler(CHECKPOINT_CODE, '1 2 3 4 5 6', io.StringIO(), seed=7)
+    expected = run_all(m)
+    m = Compiler(CHECKPOINT_CODE, '1 2 3 4 5 6', io.StringIO(), seed=7)
+    m.run(checkpoint=path, every=60)
+    resumed = Compiler(CHECKPOINT_CODE, '1 2 3 4 5 6', io.StringIO())
+    resumed.resume(path)
+    assert 120 <= resumed.steps < expected[-1]
+    assert run_all(resumed)[1:] == expected[1:]
+    with pytest.raises(ValueError):
+        Compiler(CHECKPOINT_CODE, '6 5 4 3 2 1').resume(path)
+
+
+def test_steady_state_allocation():
+    """
+    Once warmed up, evaluating symbols should not keep any memory,
+    or make copies of the (long) routine being run.
+    """
+    padding = ' ' * 10000
+    code = f"X=0 4(X=X+1 Y=X*300/7&1000 #SQ 3; {padding})\n$\nSQ Z=%A*%A @"
+    m = Compiler(code)
+    steps = len(code)
+    for _ in range(steps):  # once round the loop
+        m.evaluate()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        for _ in range(steps):
+            m.evaluate()
+        after, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert m.variables['X'] == 3
+    assert after - before < 256
+    assert peak - before < 4096
@@ -0,0 +1,72 @@
+import json
+import threading
+from http.client import HTTPConnection
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import pytest
+from musyserver import Server, compile_job
+
+
+def post(server, body):
+    url = 'http://%s:%s/run' % server.server_address
+    try:
+        with urlopen(url, json.dumps(body).encode()) as r:
+            return r.status, json.load(r)
+    except HTTPError as e:
+        return e.code, json.load(e)
+
+
+@pytest.fixture
+def server():
+    s = Server(('127.0.0.1', 0), workers=1, queue=0, max_steps=10000)
+    t = threading.Thread(target=s.serve_forever)
+    t.start()
+    yield s
+    s.shutdown()
+    s.server_close()
+    t.join()
+
+
+def test_compile_job():
+    result = compile_job(r'O.K1. 1000: 10+5\ $')
+    assert result['error'] is None
+    assert result['stdout'] == '15\n'
+    assert result['buses'][0] == ['0010', '1750']
+
+
+def test_compile_job_step_limit():
+    result = compile_job('"LOOP"\n1 1[G1]\n$', max_steps=100)
+    assert 'within 100 steps' in result['error']
+
+
+def test_server_run(server):
+    status, result = post(server, {'source': 'O1.56. T1.1. $', 'render': True})
+    assert status == 200
+    assert result['buses'][0] == ['0170', '7401']
+    assert result['output'].startswith('(set-control-srate')
+
+
+def test_server_errors(server):
+    assert post(server, {'input': '1 2 3'})[0] == 400
+    assert post(server, {'source': 5})[0] == 400
+    assert post(server, {'source': '1 $', 'input': 5})[0] == 400
+    status, result = post(server, {'source': '"TRUTH MACHINE"\n1 1[G1]\n$'})
+    assert status == 422
+    assert 'steps' in result['error']
+
+
+def post_length(server, length):
+    """POST a request declaring Content-Length length, without sending a body."""
+    conn = HTTPConnection(*server.server_address, timeout=5)
+    conn.putrequest('POST', '/run')
+    conn.putheader('Content-Length', str(length))
+    conn.endheaders()
+    status = conn.getresponse().status
+    conn.close()
+    return status
+
+
+def test_server_bad_content_length(server):
+    assert post_length(server, -1) == 400
+    assert post_length(server, 10 ** 9) == 413
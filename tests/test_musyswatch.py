@@ -0,0 +1,76 @@
+from musysim import Compiler
+from musyswatch import Session, edit
+from sofkasim import Performance, Sofka
+
+
+SCORE = """1 #NT 40, 5;
+2 #NT 44, 3;
+3 5(#NT 47, 2;)
+4 #NT 52, 8;
+$
+NT O1.%A. A1.10. E1.%B. T1.%B. E1.3. T1.1. @
+"""
+
+
+def test_reload_reuses_unchanged():
+    m = Compiler(SCORE + 'UP X=X+1 @\n')
+    nt, up = m.macros['NT'], m.macros['UP']
+    changes = m.reload(SCORE.replace('2 #NT 44', '2 #NT 45').replace('E1.3.', 'E1.4.'))
+    assert changes == ['line 2', 'macro NT', 'macro UP removed']
+    assert m.macros['NT'] is not nt and 'UP' not in m.macros
+    assert m.lines == {1: 0, 2: 1, 3: 2, 4: 3}
+    assert m.main_program[1] == '#NT 45, 3;'
+    m = Compiler(SCORE + 'UP X=X+1 @\n')
+    assert m.reload(SCORE + 'UP X=X+1 @\n') == []
+    assert m.macros['NT'] is not nt  # a new Compiler parses everything
+    assert Compiler(SCORE).reload(SCORE + 'UP X=X+1 @\n') == ['macro UP']
+    assert m.reload(SCORE.replace('4 #NT 52, 8;\n', '')) == ['1 line removed', 'macro UP removed']
+
+
+def test_performance_rerenders_from_first_difference():
+    performance = Performance(every=4)
+    scores = [SCORE, SCORE.replace('4 #NT 52', '4 #NT 53'), SCORE.replace('3 5(', '3 3('), SCORE]
+    replayed = []
+    for score in scores:
+        m = Compiler(score)
+        m.run()
+        assert performance.render(m.lists()) == Sofka(m.lists()).perform()
+        replayed.append(performance.replayed)
+    words = len(performance.words)
+    assert replayed[0] == words
+    assert replayed[1] <= 6 + 4  # only the last note (6 words) changed
+    assert replayed[3] < words
+
+
+def test_performance_appends_at_multiple_of_every():
+    performance = Performance(every=4)
+    lists = '0170 7401 0171 7402'
+    assert performance.render(lists) == Sofka(lists).perform()
+    for lists in (lists + ' 0172', lists + ' 0172 7403 0173 7404', lists + ' 0172 7403 0173 7404 0174'):
+        assert performance.render(lists) == Sofka(lists).perform()
+    assert performance.replayed <= 4 + 1  # from the last saved state
+
+
+def test_edit():
+    assert edit(SCORE, '2 #NT 30, 1;').split('\n')[1] == '2 #NT 30, 1;'
+    source = edit(SCORE, '5 #NT 30, 1;')
+    assert source.split('\n')[4] == '5 #NT 30, 1;'
+    source = edit(source, '0 X=1')
+    assert source.startswith('0 X=1\n1 #NT')
+    assert '3 ' not in edit(SCORE, '3')
+    assert edit(SCORE, 'NT O2.%A. @').endswith('$\nNT O2.%A. @\n')
+    assert edit(SCORE, 'UP X=X+1 @').endswith('T1.1. @\nUP X=X+1 @\n')
+    assert edit(SCORE, r'10+5\ ') is None
+
+
+def test_session():
+    session = Session(SCORE, max_steps=10000)
+    assert session.error is None
+    assert session.output.startswith('(set-control-srate')
+    report = session.update(edit(session.source, '4 #NT 52, 9;'))
+    assert report.startswith('Recompiled line 4 in')
+    assert session.output == Session(session.source).output
+    assert 'Not recompiled' in session.update('no dollar')
+    assert session.immediate(r'#NT 40, 5; 10+5\ ').stdout.getvalue() == '15\n'
+    assert session.update(SCORE.replace('4 #NT 52, 8;', '4 "LOOP"\n5 1[G5]'))
+    assert 'steps' in session.error
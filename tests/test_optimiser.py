@@ -0,0 +1,110 @@
+import io
+import random
+
+import conformance
+import pytest
+from conformance import random_programs
+from musysim import Compiler, StepLimitExceeded
+from optimiser import const_value, optimise
+
+
+def run(code, optimised, **kwargs):
+    random.seed(1)
+    m = Compiler(code, stdout=io.StringIO())
+    report = optimise(m, **kwargs) if optimised else []
+    try:
+        m.run(10000)
+    except StepLimitExceeded:
+        pass
+    return m, report
+
+
+def assert_same(code, **kwargs):
+    """Run code with and without optimisation, checking the results match."""
+    plain, _ = run(code, False)
+    optimised, report = run(code, True, **kwargs)
+    assert optimised.EXP == plain.EXP
+    assert optimised.variables == plain.variables
+    assert optimised.stdout.getvalue() == plain.stdout.getvalue()
+    assert [b.data for b in optimised.buses] == [b.data for b in plain.buses]
+    return optimised, report
+
+
+def test_const_value():
+    assert const_value('100*200/10') == 2000
+    assert const_value('10-5*4') == 20
+    assert const_value('2047+5') == 2052
+    assert const_value('5/0') is None
+
+
+def test_fold_constants():
+    m, report = assert_same(r"100*200/10\ X=2047+5 X\ 10-5*4+X\ 3-5\ $")
+    assert m.main_program == [r"2000\ X=2052 X\ 20+X\ 3-5\ "]
+    assert len(report) == 3
+
+
+def test_remove_dead_code():
+    code = '"START"\n1 X=X+1 X-3[G2] G1 X=100\n"NEVER"\n2 X\\\n$'
+    m, report = assert_same(code)
+    assert m.main_program == ['"START"', 'X=X+1 X-3[G2] G1', 'X\\']
+    assert m.lines == {1: 1, 2: 2}
+    assert len(report) == 2
+
+
+def test_bracket_in_string_ends_false_condition():
+    # The ] in the string ends the false condition, so X=9 and line 5 are reached
+    m, report = assert_same('0-1[ "]" G5 ] X=9\n5 Y=1\n$')
+    assert m.stdout.getvalue() == ' G5 ] X=9Y=1'
+    assert report == []
+
+
+def test_inline_macros():
+    code = r"""
+        4(#NOTE 56, 12, 15;
+        ) #SQ 0-3; \
+        $
+        NOTE O1.%A. A1.%B. E1.%B/2+7. T1.%C-1. @
+        SQ "SQUARE" %A*%A @
+    """
+    m, report = assert_same(code)
+    assert '#' not in ''.join(m.main_program)
+    assert "line 1: inlined '#NOTE 56, 12, 15;'" in report
+
+
+@pytest.mark.parametrize('code', [
+    r"#FAC 4; \ $ FAC %A-1 [#FAC %A-1; N=%A*N @] N=1 @",  # recursive
+    r"X=3 #MM X; \ $ MM %A+1 @",  # argument not constant
+    '"S"\n#MM 0; X=X+1 X\\\n$ MM %A(Y=Y+1) @',  # a repeat count of 0 restarts the routine
+])
+def test_not_inlined(code):
+    m, report = assert_same(code)
+    assert report == []
+
+
+def test_not_folded_next_to_formal_parameter():
+    # 5+1%A with A=2 is 5+12, not 6%A
+    m, report = assert_same(r"#MM 2; \ $ MM 5+1%A @", size=0)
+    assert report == []
+    # %A1+2*3 with A=7 is 71+2*3, so 2*3 is not an expression of its own
+    m, report = assert_same(r"#MM 7; \ $ MM %A1+2*3\ @", size=0)
+    assert report == []
+
+
+def test_not_folded_after_macro_call():
+    # A return with @ skips the character after the call, here the 7 of 71&22
+    code = '5 #MB 1;\n71&22[1"YES"]\n$\nMB 1[@] @\n'
+    m, report = assert_same(code)
+    assert m.main_program[1] == '71&22[1"YES"]'
+    m, report = assert_same(r'#MB 1;12+3\ $ MB 1[@] @')
+    assert report == []
+
+
+def final_state(source, input_, optimise):
+    state, _ = conformance.run(source, input_, 'fast', 1, 20000, optimise)
+    del state['steps']  # optimising saves steps
+    return state
+
+
+@pytest.mark.parametrize('name, source, input_', [*random_programs(100), *random_programs(1, seed=258)])
+def test_optimised_random_programs_agree(name, source, input_):
+    assert final_state(source, input_, True) == final_state(source, input_, False)